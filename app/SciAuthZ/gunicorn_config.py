@@ -0,0 +1,76 @@
+"""
+Gunicorn configuration for SciAuthZ.
+
+Start the server with:
+    gunicorn SciAuthZ.wsgi:application -c SciAuthZ/gunicorn_config.py
+
+Every setting can be overridden with the environment variable named in it.
+"""
+
+import math
+import os
+import shutil
+
+def get_cpu_limit():
+    """
+    Returns the number of CPUs the server may use. Inside a container that is its CPU quota, if it has one,
+    rather than the host's CPU count, which is all that multiprocessing.cpu_count() sees.
+    """
+
+    cpus = len(os.sched_getaffinity(0))
+
+    try:
+        # cgroup v2 holds "<quota> <period>", or "max <period>" without a quota
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (IOError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except IOError:
+            return cpus
+
+    if quota in ("max", "-1"):
+        return cpus
+
+    return max(1, min(cpus, int(math.ceil(int(quota) / float(period)))))
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8004")
+
+# Requests mostly wait on MySQL and the shared cache, so each worker serves several at once on threads
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", get_cpu_limit() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Load Django once in the master so workers start quickly and share its memory
+preload_app = True
+
+# Recycle workers after a number of requests, staggered so they do not all restart together
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 1000))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Workers write their Prometheus metrics to files here so that /metrics can add them up. It must be set before the app is loaded.
+os.environ.setdefault("prometheus_multiproc_dir", "/tmp/sciauthz-metrics")
+
+def on_starting(server):
+    # Start from empty metrics; the preloaded app has not recorded any yet
+    metrics_dir = os.environ["prometheus_multiproc_dir"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+def post_fork(server, worker):
+    # A database connection opened while preloading must not be shared by the workers
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+def child_exit(server, worker):
+    # Keep the counters of a recycled worker but drop its live gauges
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
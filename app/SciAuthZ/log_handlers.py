@@ -0,0 +1,69 @@
+import logging
+import logging.config
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Puts log records on a queue for a background thread to pass to the given handlers, so that writing to
+    stdout and the log files does not hold up the request. The thread also formats the records, so a message
+    is only built once it is going to be written.
+
+    Threads do not survive a fork, so each process starts its own listener the first time it logs.
+    """
+
+    def __init__(self, handlers=()):
+        super(BackgroundHandler, self).__init__(queue.Queue(-1))
+        self.handlers = list(handlers)
+        self.listener = None
+        self.pid = None
+        self._start_lock = threading.Lock()
+
+    def prepare(self, record):
+        # The record never leaves the process, so it does not need to be formatted for pickling
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            # Threads logging together in a new process must not each start a listener
+            with self._start_lock:
+                if self.pid != os.getpid():
+                    self.start()
+        self.queue.put_nowait(record)
+
+    def start(self):
+        # A queue copied by a fork may hold records for the parent's listener
+        self.queue = queue.Queue(-1)
+
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def close(self):
+        # Stopping the listener writes out the records still on the queue
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+        self.listener = None
+        self.pid = None
+
+        super(BackgroundHandler, self).close()
+
+
+def configure_logging(logging_settings):
+    """
+    Configures logging from the LOGGING setting, then puts the root logger's handlers behind a BackgroundHandler
+    so that the records logged through it are written by a background thread. Set as LOGGING_CONFIG.
+    """
+
+    logging.config.dictConfig(logging_settings)
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(BackgroundHandler(handlers))
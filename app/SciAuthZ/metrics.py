@@ -0,0 +1,73 @@
+"""
+The Prometheus metrics of SciAuthZ, served at /metrics.
+
+Under gunicorn every worker writes its metrics to files in the prometheus_multiproc_dir directory, which
+SciAuthZ/gunicorn_config.py sets, and /metrics adds them up across the workers.
+"""
+
+import os
+
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+
+REQUESTS = Counter(
+    'sciauthz_requests_total',
+    'Requests handled, by view, action, method and status.',
+    ['view', 'action', 'method', 'status']
+)
+
+REQUEST_DURATION = Histogram(
+    'sciauthz_request_duration_seconds',
+    'Time taken to handle a request, by view and action.',
+    ['view', 'action'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+
+DB_QUERIES = Histogram(
+    'sciauthz_db_queries_per_request',
+    'Database round trips made by a request, by view and action.',
+    ['view', 'action'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+)
+
+DB_DURATION = Histogram(
+    'sciauthz_db_duration_seconds',
+    'Time a request spent in database queries, by view and action.',
+    ['view', 'action'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+)
+
+CACHE_LOOKUPS = Counter(
+    'sciauthz_cache_lookups_total',
+    'Cache lookups, by cache and result: the per-worker (local) and shared permission caches, the permission snapshot (snapshot) and verified tokens (token).',
+    ['cache', 'result']
+)
+
+def get_metrics():
+    """
+    Returns the metrics in the Prometheus text format, added up across processes in multiprocess mode.
+    """
+
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+
+    return generate_latest(REGISTRY)
+
+def get_view_labels(view_func, method):
+    """
+    Returns the view and action labels of a request: the viewset and the action the method is routed to
+    for DRF viewsets, such as UserPermissionViewSet and check, or the view's name and an empty action.
+    """
+
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return view_func.__name__, ''
+
+    actions = getattr(view_func, 'actions', None) or {}
+    return view_class.__name__, actions.get(method.lower(), '')
@@ -0,0 +1,175 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.backends.utils import CursorWrapper
+from django.dispatch import receiver
+
+from SciAuthZ.metrics import DB_DURATION
+from SciAuthZ.metrics import DB_QUERIES
+from SciAuthZ.metrics import REQUEST_DURATION
+from SciAuthZ.metrics import REQUESTS
+from SciAuthZ.metrics import get_view_labels
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ConnectionHealthCheckMiddleware(object):
+    """
+    Persistent database connections (CONN_MAX_AGE) can be dropped by MySQL or the network while a worker
+    is idle. Before a request, each connection that has not been used for DB_HEALTH_CHECK_INTERVAL seconds
+    is pinged, and closed if it no longer responds so that Django opens a new one instead of failing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        interval = getattr(settings, 'DB_HEALTH_CHECK_INTERVAL', 30)
+        now = time.monotonic()
+
+        for connection in connections.all():
+            last_used = getattr(connection, 'last_request_at', None)
+
+            if connection.connection is not None and last_used is not None and now - last_used > interval:
+                if not connection.is_usable():
+                    logger.warning('[SCIAUTHZ][ConnectionHealthCheckMiddleware] - Closing unusable connection %s.', connection.alias)
+                    connection.close()
+
+        response = self.get_response(request)
+
+        for connection in connections.all():
+            connection.last_request_at = time.monotonic()
+
+        return response
+
+# The queries of the request this thread is handling, set by QueryInstrumentationMiddleware. Django's
+# connections are per thread as well, so a cursor only ever adds to its own request's queries.
+request_queries = threading.local()
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """
+    Times each query made during a request into request_queries. Unlike Django's CursorDebugWrapper it keeps
+    the SQL and parameters as they are, so nothing is formatted unless the request turns out to be slow.
+    """
+
+    def execute(self, sql, params=None):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedCursorWrapper, self).execute(sql, params)
+        finally:
+            self.record(sql, params, started)
+
+    def executemany(self, sql, param_list):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.record(sql, param_list, started)
+
+    def record(self, sql, params, started):
+        queries = getattr(request_queries, 'queries', None)
+        if queries is not None:
+            queries.append((sql, params, time.perf_counter() - started))
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """
+    Makes the connection hand out InstrumentedCursorWrappers around the cursors it would otherwise hand out,
+    including the debug cursors used with DEBUG or in tests. This is done once for each connection object, which
+    keeps it across reconnects.
+    """
+
+    if getattr(connection, 'instrumented', False):
+        return
+
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+
+    connection.make_cursor = lambda cursor: InstrumentedCursorWrapper(make_cursor(cursor), connection)
+    connection.make_debug_cursor = lambda cursor: InstrumentedCursorWrapper(make_debug_cursor(cursor), connection)
+    connection.instrumented = True
+
+class QueryInstrumentationMiddleware(object):
+    """
+    Counts and times the database queries of each request along with the request itself. The numbers are
+    sent back in a Server-Timing header (if SERVER_TIMING_HEADER is set). Requests slower than
+    SLOW_REQUEST_THRESHOLD_MS are logged as warnings with their SQL, and with the numbers as extra fields.
+
+    Queries made while a streaming response is being sent are not counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        # Connections opened before the middleware was loaded, such as the test database's, were not instrumented
+        for connection in connections.all():
+            instrument_connection(sender=connection.__class__, connection=connection)
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        queries = request_queries.queries = []
+
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.queries = None
+
+        total_time = (time.perf_counter() - started) * 1000
+        db_time = sum(query[2] for query in queries) * 1000
+
+        # For MetricsMiddleware
+        request.db_queries = len(queries)
+        request.db_time = db_time / 1000
+
+        if getattr(settings, 'SERVER_TIMING_HEADER', True):
+            response['Server-Timing'] = 'db;desc="%s queries";dur=%.2f, total;dur=%.2f' % (len(queries), db_time, total_time)
+
+        # Every request is already counted in the metrics, so only the slow ones are logged
+        if total_time >= getattr(settings, 'SLOW_REQUEST_THRESHOLD_MS', 500):
+            fields = {
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'db_queries': len(queries),
+                'db_time_ms': round(db_time, 2),
+                'total_time_ms': round(total_time, 2),
+            }
+
+            sql = '\n'.join('%.2fms %s %r' % (duration * 1000, statement, params) for statement, params, duration in queries)
+            logger.warning('[SCIAUTHZ][QueryInstrumentationMiddleware] - Slow request %s %s (%s) took %.2fms with %s queries in %.2fms:\n%s',
+                           request.method, request.path, response.status_code, total_time, len(queries), db_time, sql, extra=fields)
+
+        return response
+
+class MetricsMiddleware(object):
+    """
+    Counts requests and records their latency, database round trips and database time in the Prometheus
+    metrics, by the view and action that handled them. It relies on QueryInstrumentationMiddleware, placed
+    after it, for the database numbers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        # Requests that did not resolve to a view, such as 404s, are counted under an empty view
+        view, action = getattr(request, 'metrics_labels', ('', ''))
+
+        REQUESTS.labels(view, action, request.method, str(response.status_code)).inc()
+        REQUEST_DURATION.labels(view, action).observe(duration)
+
+        if hasattr(request, 'db_queries'):
+            DB_QUERIES.labels(view, action).observe(request.db_queries)
+            DB_DURATION.labels(view, action).observe(request.db_time)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_labels = get_view_labels(view_func, request.method)
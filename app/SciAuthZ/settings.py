@@ -52,6 +52,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'SciAuthZ.middleware.MetricsMiddleware',
+    'SciAuthZ.middleware.QueryInstrumentationMiddleware',
+    'SciAuthZ.middleware.ConnectionHealthCheckMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,12 +91,39 @@ WSGI_APPLICATION = 'SciAuthZ.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
-        'NAME': 'sciauthz',
+        'ENGINE': os.environ.get("DATABASE_ENGINE", 'django.db.backends.mysql'),
+        'NAME': os.environ.get("DATABASE_NAME", 'sciauthz'),
         'USER': os.environ.get("MYSQL_USERNAME"),
         'PASSWORD': os.environ.get("MYSQL_PASSWORD"),
         'HOST': os.environ.get("MYSQL_HOST"),
         'PORT': os.environ.get("MYSQL_PORT"),
+
+        # Keep connections open between requests instead of connecting for each one
+        'CONN_MAX_AGE': int(os.environ.get("MYSQL_CONN_MAX_AGE", 300)),
+    }
+}
+
+# Idle persistent connections are checked before they are reused after this many seconds
+DB_HEALTH_CHECK_INTERVAL = int(os.environ.get("DB_HEALTH_CHECK_INTERVAL", 30))
+
+# Each response reports its query count, query time and total time in a Server-Timing header
+SERVER_TIMING_HEADER = os.environ.get("SERVER_TIMING_HEADER", "true").lower() == "true"
+
+# Requests slower than this are logged as warnings along with their SQL
+SLOW_REQUEST_THRESHOLD_MS = int(os.environ.get("SLOW_REQUEST_THRESHOLD_MS", 500))
+
+# Scrapers send this as a bearer token to read /metrics, which is not served without it
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+
+# Workers share the permission versions through this cache. The local memory default is only for development:
+# with DEBUG off, the authorization.E001 check refuses it and the server does not start.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get("CACHE_LOCATION", 'sciauthz'),
     }
 }
 
@@ -138,11 +168,41 @@ REST_FRAMEWORK = {
     ),
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'pyauth0jwtrest.authentication.Auth0JSONWebTokenAuthentication',
+        'authorization.authentication.CachedAuth0JSONWebTokenAuthentication',
     ),
     'DATETIME_FORMAT': '%Y-%m-%dT%H:%M:%S'
 }
 
+# Each permission and the permissions it implies, so that a MANAGE record also answers EDIT and VIEW checks
+PERMISSION_LATTICE = {
+    'MANAGE': ['EDIT'],
+    'EDIT': ['VIEW'],
+}
+
+# Per-worker cache of each user's permissions
+PERMISSION_CACHE_MAX_SIZE = int(os.environ.get("PERMISSION_CACHE_MAX_SIZE", 10000))
+PERMISSION_CACHE_TTL = int(os.environ.get("PERMISSION_CACHE_TTL", 60))
+
+# Cache shared by all workers, holding versioned permissions
+PERMISSION_SHARED_CACHE_ALIAS = 'default'
+PERMISSION_SHARED_CACHE_TTL = int(os.environ.get("PERMISSION_SHARED_CACHE_TTL", 300))
+
+# Most permissions that can be checked in one batch request
+PERMISSION_CHECK_BATCH_LIMIT = 1000
+
+# Rows written or read per statement by the bulk permission actions
+PERMISSION_BULK_BATCH_SIZE = 500
+
+# Snapshot of every permission that all workers map to answer checks, built by refresh_permission_snapshot.
+# Checks only use it for users whose permissions have not changed since it was built. Unset to turn it off.
+PERMISSION_SNAPSHOT_PATH = os.environ.get("PERMISSION_SNAPSHOT_PATH")
+PERMISSION_SNAPSHOT_CHECK_INTERVAL = 1
+
+# Seconds the shared cache logs which users each change touched, and the most changes a worker reads at once
+# to find them. A worker further behind does not use the snapshot until it is rebuilt.
+PERMISSION_CHANGE_LOG_TTL = int(os.environ.get("PERMISSION_CHANGE_LOG_TTL", 3600))
+PERMISSION_CHANGE_LOG_MAX_READ = 1000
+
 AUTH0_DOMAIN = os.environ.get("AUTH0_DOMAIN")
 AUTH0_CLIENT_ID_LIST = os.environ.get("AUTH0_CLIENT_ID_LIST").split(",")
 AUTH0_SECRET = os.environ.get("AUTH0_SECRET")
@@ -158,6 +218,14 @@ AUTH0 = {
     'CREATE_USERS': False,
 }
 
+# Signing keys are read from this JWKS file if it is set, otherwise from the Auth0 domain, and refreshed periodically
+AUTH0_JWKS_FILE = os.environ.get("AUTH0_JWKS_FILE")
+AUTH0_JWKS_REFRESH_INTERVAL = int(os.environ.get("AUTH0_JWKS_REFRESH_INTERVAL", 3600))
+AUTH0_JWKS_MIN_REFRESH_INTERVAL = 30
+
+# Verified token claims kept per worker until the tokens expire
+JWT_CLAIMS_CACHE_MAX_SIZE = 10000
+
 AUTHENTICATION_LOGIN_URL = os.environ.get("AUTHENTICATION_LOGIN_URL")
 
 AUTHENTICATION_BACKENDS = ('pyauth0jwt.auth0authenticate.Auth0Authentication', 'django.contrib.auth.backends.ModelBackend')
@@ -174,6 +242,12 @@ EMAIL_HOST_USER = os.environ.get("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_HOST_PASSWORD")
 EMAIL_PORT = os.environ.get("EMAIL_PORT")
 
+# Set to INFO or above in production to skip the debug messages entirely
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+
+# The root logger's handlers are moved behind a BackgroundHandler once the LOGGING below is configured
+LOGGING_CONFIG = 'SciAuthZ.log_handlers.configure_logging'
+
 LOGGING = {
     'version': 1,
     'handlers': {
@@ -194,7 +268,7 @@ LOGGING = {
     },
     'root': {
         'handlers': ['console', 'file_debug'],
-        'level': 'DEBUG'
+        'level': LOG_LEVEL
     },
     'loggers': {
         'django': {
@@ -13,6 +13,9 @@ DEBUG = True
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+# Tests log synchronously
+LOGGING_CONFIG = 'logging.config.dictConfig'
+
 LOGGING = {
     'version': 1,
     'handlers': {
@@ -44,6 +47,13 @@ LOGGING = {
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sciauthz-test',
+    }
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',
                                    'rest_framework.permissions.DjangoModelPermissions'),
@@ -20,6 +20,7 @@ from django.contrib import admin
 from rest_framework import routers
 from authorization import views
 from .views import ht
+from .views import metrics
 
 router = routers.DefaultRouter()
 router.register(r'user', views.UserViewSet)
@@ -30,5 +31,6 @@ urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^login/', views.login),
     url(r'^ht/', ht),
+    url(r'^metrics/?$', metrics),
     url(r'^', include(router.urls))
 ]
\ No newline at end of file
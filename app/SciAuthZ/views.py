@@ -1,5 +1,27 @@
+import hmac
+
+from django.conf import settings
+from django.http import Http404
 from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from SciAuthZ.metrics import get_metrics
 
 
 def ht(request):
     return HttpResponse('')
+
+
+def metrics(request):
+    # Behind the load balancer every request comes from a private address, so scrapers are told apart by a token
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        raise Http404('Metrics are not served without a METRICS_TOKEN.')
+
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % token).encode('utf-8')):
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+
+    return HttpResponse(get_metrics(), content_type=CONTENT_TYPE_LATEST)
@@ -1,12 +1,21 @@
 from django.contrib import admin
-from .models import UserPermission, UserPermissionRequest
+from .models import Item, PermissionType, UserPermission, UserPermissionRequest
 
 class UserPermissionAdmin(admin.ModelAdmin):
     list_display = ('user_email', 'item', 'permission', 'date_updated')
 
+class ItemAdmin(admin.ModelAdmin):
+    list_display = ('name', 'date_created')
+    search_fields = ('name',)
+
+class PermissionTypeAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+
 # TODO Delete
 class UserPermissionRequestAdmin(admin.ModelAdmin):
     list_display = ('user', 'item', 'date_requested', 'request_granted', 'date_request_granted')
 
 admin.site.register(UserPermission, UserPermissionAdmin)
+admin.site.register(Item, ItemAdmin)
+admin.site.register(PermissionType, PermissionTypeAdmin)
 admin.site.register(UserPermissionRequest, UserPermissionRequestAdmin)
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class AuthorizationConfig(AppConfig):
     name = 'authorization'
+
+    def ready(self):
+        # Connect the signal handlers that keep the permission cache fresh
+        import authorization.signals
+
+        # Register the checks that refuse settings the permission cache cannot work with
+        import authorization.checks
@@ -0,0 +1,258 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+import requests
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.x509 import load_pem_x509_certificate
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+
+# The authentication module must be imported before the utils to avoid a circular import
+from pyauth0jwtrest.authentication import Auth0JSONWebTokenAuthentication
+from pyauth0jwtrest.settings import auth0_api_settings
+from pyauth0jwtrest.utils import get_jwt_value
+
+from SciAuthZ.metrics import CACHE_LOOKUPS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Seconds of clock skew allowed when checking a token's timestamps, as in pyauth0jwtrest
+JWT_LEEWAY = 60
+
+class SigningKeys(object):
+    """
+    The public keys that tokens are signed with, keyed by key ID. They are read from the AUTH0_JWKS_FILE
+    if it is set, or from the Auth0 domain's JWKS endpoint, and refreshed in a background thread every
+    AUTH0_JWKS_REFRESH_INTERVAL seconds. An unknown key ID triggers an early refresh, at most once every
+    AUTH0_JWKS_MIN_REFRESH_INTERVAL seconds, to pick up rotated keys.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._loaded_at = None
+        self._refresher_pid = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def get(self, key_id):
+        """
+        Returns the public key with the given ID, or the first key if the token does not name one.
+        """
+
+        self._start_refresher()
+
+        key = self._find(key_id)
+        if key is None:
+            # Threads that miss together wait for a single refresh rather than failing while it loads
+            with self._refresh_lock:
+                key = self._find(key_id)
+                if key is None and self._can_refresh():
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        logger.exception('[SCIAUTHZ][SigningKeys] - Failed to load signing keys: %s', e)
+                    key = self._find(key_id)
+
+        if key is None:
+            raise exceptions.AuthenticationFailed(_('Unknown signing key.'))
+
+        return key
+
+    def refresh(self):
+        """
+        Loads the keys from the JWKS and swaps them in. The load is only recorded once it has finished, successfully
+        or not, so that a load still in progress is not taken for a recent one.
+        """
+
+        try:
+            jwks_file = getattr(settings, 'AUTH0_JWKS_FILE', None)
+            if jwks_file:
+                with open(jwks_file) as f:
+                    jwks = json.load(f)
+            else:
+                jwks = requests.get("https://" + auth0_api_settings.DOMAIN + "/.well-known/jwks.json", timeout=5).json()
+
+            keys = OrderedDict()
+            for jwk in jwks['keys']:
+                if jwk.get('x5c'):
+                    cert = '-----BEGIN CERTIFICATE-----\n' + jwk['x5c'][0] + '\n-----END CERTIFICATE-----'
+                    keys[jwk.get('kid')] = load_pem_x509_certificate(str.encode(cert), default_backend()).public_key()
+
+            self._keys = keys
+        finally:
+            with self._lock:
+                self._loaded_at = time.monotonic()
+
+        logger.debug('[DEBUG][SCIAUTHZ][SigningKeys] - Loaded %s signing keys.', len(keys))
+
+    def clear(self):
+        self._keys = {}
+        self._loaded_at = None
+
+    def _find(self, key_id):
+        keys = self._keys
+        if key_id is None:
+            return next(iter(keys.values()), None)
+        return keys.get(key_id)
+
+    def _can_refresh(self):
+        min_interval = getattr(settings, 'AUTH0_JWKS_MIN_REFRESH_INTERVAL', 30)
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > min_interval
+
+    def _start_refresher(self):
+        # Threads do not survive a fork, so each gunicorn worker starts its own
+        if self._refresher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+
+        thread = threading.Thread(target=self._refresh_periodically, name='sciauthz-jwks-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_periodically(self):
+        while True:
+            time.sleep(getattr(settings, 'AUTH0_JWKS_REFRESH_INTERVAL', 3600))
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception('[SCIAUTHZ][SigningKeys] - Failed to refresh signing keys: %s', e)
+
+class VerifiedTokenCache(object):
+    """
+    A thread-safe LRU cache of the claims of verified tokens, keyed by a hash of the token. An entry
+    expires with its token, so a token is only verified once for as long as it is valid.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expires, claims = entry
+
+                if expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return claims
+
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, claims, expires):
+        with self._lock:
+            self._entries[key] = (expires, claims)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+signing_keys = SigningKeys()
+verified_tokens = VerifiedTokenCache(max_size=getattr(settings, 'JWT_CLAIMS_CACHE_MAX_SIZE', 10000))
+
+def get_client_secret():
+    """
+    Returns the key HS256 tokens are signed with. As in pyauth0jwtrest, the client secret is base64 decoded unless
+    CLIENT_SECRET_BASE64_ENCODED is False in the AUTH0 settings.
+    """
+
+    secret = auth0_api_settings.CLIENT_SECRET
+
+    if auth0_api_settings.CLIENT_SECRET_BASE64_ENCODED:
+        return base64.b64decode(secret.replace("_", "/").replace("-", "+"))
+
+    return secret
+
+def verify_token(jwt_value):
+    """
+    Verifies the token's signature, audience and expiry and returns its claims. The AUTH0 settings, and their
+    defaults, are read through pyauth0jwtrest as Auth0JSONWebTokenAuthentication reads them.
+    """
+
+    # Check that the Client ID (aud) the JWT pertains to is allowed for this application
+    try:
+        header = jwt.get_unverified_header(jwt_value)
+        auth0_client_id = str(jwt.decode(jwt_value, verify=False)['aud'])
+    except Exception:
+        raise exceptions.AuthenticationFailed(_('Failed to get the aud from jwt payload'))
+
+    if auth0_client_id not in auth0_api_settings.CLIENT_ID_LIST:
+        raise exceptions.AuthenticationFailed(_('Auth0 Client ID not allowed'))
+
+    if auth0_api_settings.ALGORITHM.upper() == "HS256":
+        key = get_client_secret()
+    else:
+        key = signing_keys.get(header.get('kid'))
+
+    try:
+        return jwt.decode(
+            jwt_value,
+            key,
+            verify=True,
+            algorithms=[auth0_api_settings.ALGORITHM],
+            audience=auth0_client_id,
+            leeway=JWT_LEEWAY
+        )
+    except jwt.ExpiredSignature:
+        raise exceptions.AuthenticationFailed(_('Signature has expired.'))
+    except jwt.DecodeError:
+        raise exceptions.AuthenticationFailed(_('Error decoding signature.'))
+    except jwt.InvalidTokenError:
+        raise exceptions.AuthenticationFailed()
+
+class CachedAuth0JSONWebTokenAuthentication(Auth0JSONWebTokenAuthentication):
+    """
+    Authenticates requests with an Auth0 JWT as Auth0JSONWebTokenAuthentication does, but remembers the claims
+    of tokens it has verified until they expire and keeps the signing keys in memory instead of fetching them
+    for every request. The claims are returned as the request's auth, so the email can be read from them.
+    """
+
+    def authenticate(self, request):
+        jwt_value = get_jwt_value(request)
+        if jwt_value is None:
+            return None
+
+        key = hashlib.sha256(jwt_value).hexdigest()
+
+        claims = verified_tokens.get(key)
+        CACHE_LOOKUPS.labels('token', 'miss' if claims is None else 'hit').inc()
+
+        if claims is None:
+            claims = verify_token(jwt_value)
+
+            # Tokens without an expiry are only trusted for as long as the signing keys
+            expires = claims.get('exp', time.time() + getattr(settings, 'AUTH0_JWKS_REFRESH_INTERVAL', 3600))
+            verified_tokens.set(key, claims, expires)
+
+        return (self.authenticate_credentials(claims), claims)
@@ -0,0 +1,336 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from authorization.items import get_item_scopes
+from authorization.lattice import get_implied_permissions
+from authorization.models import UserPermission
+from authorization.models import normalize_email
+from SciAuthZ.metrics import CACHE_LOOKUPS
+
+import logging
+logger = logging.getLogger(__name__)
+
+class PermissionSet(namedtuple('PermissionSet', ['owned', 'managed_items', 'version'])):
+    """
+    The (item, permission) pairs a user holds, including those implied by the permission lattice,
+    the items they hold MANAGE on and the version of the user's permissions they were loaded at.
+    """
+
+    __slots__ = ()
+
+    def has_permission(self, item, permission):
+        return any((scope, permission) in self.owned for scope in get_item_scopes(item))
+
+    def manages(self, item):
+        return any(scope in self.managed_items for scope in get_item_scopes(item))
+
+class PermissionCache(object):
+    """
+    A thread-safe, in-process cache of PermissionSets keyed by user email. It holds at most
+    max_size users, evicting the least recently used, and entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Bumped on every invalidation so a load that raced with a write is not stored
+        self.generation = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email, version=None):
+        """
+        Returns the cached PermissionSet for the user, or None if it is missing, expired or,
+        when a version is given, was loaded at a different version.
+        """
+
+        key = normalize_email(email)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expires, permission_set = entry
+
+                if expires > time.monotonic() and (version is None or permission_set.version == version):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return permission_set
+
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, email, permission_set, generation=None):
+        """
+        Caches the PermissionSet for the user. If a generation is given and the cache has been
+        invalidated since, the PermissionSet may be stale and is discarded.
+        """
+
+        key = normalize_email(email)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, permission_set)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email):
+        """
+        Drops the cached PermissionSet for the user.
+        """
+
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(normalize_email(email), None)
+
+    def clear(self):
+        """
+        Drops every cached PermissionSet.
+        """
+
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current number of cached users.
+        """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+permission_cache = PermissionCache(
+    max_size=getattr(settings, 'PERMISSION_CACHE_MAX_SIZE', 10000),
+    ttl=getattr(settings, 'PERMISSION_CACHE_TTL', 60)
+)
+
+def get_shared_cache():
+    """
+    Returns the Django cache shared by every worker, which holds the permission versions
+    and the PermissionSets stored under them.
+    """
+
+    return caches[getattr(settings, 'PERMISSION_SHARED_CACHE_ALIAS', 'default')]
+
+def _cache_key(*parts):
+    # Emails and items may contain characters memcached does not accept in keys
+    return 'sciauthz:' + ':'.join(parts[:-1] + (hashlib.sha1(parts[-1].encode('utf-8')).hexdigest(),))
+
+def _version_key(kind, name):
+    return _cache_key('version', kind, normalize_email(name) if kind == 'user' else name)
+
+def _initial_version():
+    # Counters start from the clock rather than 1, so a counter that was evicted never
+    # comes back at a version that PermissionSets may still be cached under.
+    return int(time.time() * 1000)
+
+def _get_versions(kind, names):
+    shared_cache = get_shared_cache()
+    keys = dict((_version_key(kind, name), name) for name in names)
+
+    versions = dict((keys[key], version) for key, version in shared_cache.get_many(list(keys)).items())
+
+    for key, name in keys.items():
+        if name not in versions:
+            shared_cache.add(key, _initial_version(), timeout=None)
+            versions[name] = shared_cache.get(key)
+
+    return versions
+
+def _get_version(kind, name):
+    return _get_versions(kind, [name])[name]
+
+def _bump_version(kind, name):
+    """
+    Bumps the version and returns the new one.
+    """
+
+    shared_cache = get_shared_cache()
+    key = _version_key(kind, name)
+
+    try:
+        return shared_cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        if not shared_cache.add(key, version, timeout=None):
+            return shared_cache.incr(key)
+        return version
+
+def get_user_version(email):
+    """
+    Returns the current version of the user's permissions.
+    """
+
+    return _get_version('user', normalize_email(email))
+
+def get_user_versions(emails):
+    """
+    Returns a dict of the current versions of the users' permissions, keyed by email.
+    """
+
+    return _get_versions('user', emails)
+
+def get_change_version():
+    """
+    Returns the current version of all permissions, which every change to any of them bumps.
+    """
+
+    return _get_version('changes', 'all')
+
+def _change_key(version):
+    return _cache_key('changes', str(version))
+
+def get_changed_emails(since_version, version):
+    """
+    Returns the set of normalized emails of the users whose grants changed after since_version, up to and
+    including version, from the change log. Returns None if the log does not cover every version in between,
+    as when an entry has expired or not been written yet, or there are more than PERMISSION_CHANGE_LOG_MAX_READ.
+    """
+
+    if since_version > version or version - since_version > getattr(settings, 'PERMISSION_CHANGE_LOG_MAX_READ', 1000):
+        return None
+
+    keys = [_change_key(changed) for changed in range(since_version + 1, version + 1)]
+    entries = get_shared_cache().get_many(keys)
+    if len(entries) < len(keys):
+        return None
+
+    return set(email for emails in entries.values() for email in emails)
+
+def get_item_version(item):
+    """
+    Returns the current version of the permissions granted on the item.
+    """
+
+    return _get_version('item', item)
+
+def get_item_versions(items):
+    """
+    Returns a dict of the current versions of the permissions granted on the items, keyed by item.
+    """
+
+    return _get_versions('item', items)
+
+def invalidate_permissions(emails=(), items=(), grants_changed=True):
+    """
+    Invalidates the cached permissions of the given users and items in every worker by
+    bumping their versions. The versions are bumped again once the current transaction
+    commits, so a worker reading in between cannot cache the uncommitted state for long.
+    The change version that the snapshot is built at is only bumped if grants_changed,
+    as it is not when a grant that exists only has its date_updated refreshed. Each new
+    change version is logged with the users it changed, so that checks of everyone else
+    can still be answered from a snapshot built before it.
+    """
+
+    emails = set(normalize_email(email) for email in emails)
+    items = set(items)
+
+    def bump_versions():
+        for email in emails:
+            _bump_version('user', email)
+        for item in items:
+            _bump_version('item', item)
+        if grants_changed:
+            version = _bump_version('changes', 'all')
+            get_shared_cache().set(_change_key(version), sorted(emails), timeout=getattr(settings, 'PERMISSION_CHANGE_LOG_TTL', 3600))
+
+    for email in emails:
+        permission_cache.invalidate(email)
+
+    bump_versions()
+    transaction.on_commit(bump_versions)
+
+def load_permission_sets(versions):
+    """
+    Builds the PermissionSets for the users in a dict of versions keyed by normalized email
+    from the database, with a single query.
+    """
+
+    owned = dict((email, set()) for email in versions)
+
+    # Each record also grants the permissions implied by its own, so one row answers every implied check. The
+    # records are read by reference from the email's index, and the names from the small Item and PermissionType tables.
+    records = UserPermission.objects.filter(normalized_email__in=list(versions))
+    for email, item, permission in records.values_list('normalized_email', 'item_ref__name', 'permission_ref__name'):
+        owned[email].update((item, implied) for implied in get_implied_permissions(permission))
+
+    permission_sets = {}
+    for email, version in versions.items():
+        managed_items = frozenset(item for item, permission in owned[email] if permission == "MANAGE")
+        permission_sets[email] = PermissionSet(frozenset(owned[email]), managed_items, version)
+
+    return permission_sets
+
+def get_permission_sets(emails):
+    """
+    Returns a dict of the users' PermissionSets keyed by normalized email. Each is read from this
+    worker's cache if it is still at the user's current version, then from the shared cache, and
+    the rest are loaded from the database with a single query.
+    """
+
+    versions = get_user_versions(set(normalize_email(email) for email in emails))
+
+    permission_sets = {}
+    for email, version in versions.items():
+        permission_set = permission_cache.get(email, version)
+        if permission_set is not None:
+            permission_sets[email] = permission_set
+
+    missing = dict((email, version) for email, version in versions.items() if email not in permission_sets)
+
+    CACHE_LOOKUPS.labels('local', 'hit').inc(len(permission_sets))
+    CACHE_LOOKUPS.labels('local', 'miss').inc(len(missing))
+
+    if not missing:
+        return permission_sets
+
+    generation = permission_cache.generation
+    shared_cache = get_shared_cache()
+    keys = dict((email, _cache_key('permissions', str(version), email)) for email, version in missing.items())
+
+    cached = shared_cache.get_many(list(keys.values()))
+    for email, key in keys.items():
+        if key in cached:
+            permission_sets[email] = cached[key]
+            del missing[email]
+
+    CACHE_LOOKUPS.labels('shared', 'hit').inc(len(keys) - len(missing))
+    CACHE_LOOKUPS.labels('shared', 'miss').inc(len(missing))
+
+    if missing:
+        loaded = load_permission_sets(missing)
+        shared_cache.set_many(
+            dict((keys[email], permission_set) for email, permission_set in loaded.items()),
+            getattr(settings, 'PERMISSION_SHARED_CACHE_TTL', 300)
+        )
+        permission_sets.update(loaded)
+
+    for email in keys:
+        permission_cache.set(email, permission_sets[email], generation)
+
+    return permission_sets
+
+def get_permission_set(email):
+    """
+    Returns the PermissionSet for the user.
+    """
+
+    return get_permission_sets([email])[normalize_email(email)]
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.checks import Error
+from django.core.checks import register
+
+# Cache backends that keep their entries inside each process, so that workers cannot share versions through them
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Outside of DEBUG, the permission versions must be kept in a cache that every worker shares. Otherwise a
+    grant or revoke is only seen by the worker that made it, and the others serve the old permissions until
+    their cached entries expire.
+    """
+
+    if settings.DEBUG:
+        return []
+
+    alias = getattr(settings, 'PERMISSION_SHARED_CACHE_ALIAS', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+
+    if backend in PROCESS_LOCAL_CACHE_BACKENDS:
+        return [Error(
+            'The %s cache holds the permission versions but uses %s, which each worker keeps to itself.' % (alias, backend),
+            hint='Set CACHE_BACKEND and CACHE_LOCATION to a cache the workers share, such as memcached.',
+            id='authorization.E001',
+        )]
+
+    return []
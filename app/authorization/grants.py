@@ -0,0 +1,275 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.utils import timezone
+
+from authorization.lattice import get_implying_permissions
+from authorization.models import Item
+from authorization.models import PermissionType
+from authorization.models import UserPermission
+from authorization.models import get_name_ids
+from authorization.models import normalize_email
+from authorization.signals import permissions_changed
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _batches(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _get_connection():
+    return connections[router.db_for_write(UserPermission)]
+
+# The columns an upsert writes, and those it refreshes on a grant that exists
+UPSERT_COLUMNS = ('user_email', 'normalized_email', 'item', 'permission', 'item_ref_id', 'permission_ref_id', 'date_updated')
+UPSERT_REFRESHED_COLUMNS = ('date_updated',)
+
+def _upsert_sql(connection, row_count, on_conflict):
+    """
+    Returns an INSERT of row_count rows of the UPSERT_COLUMNS into the UserPermission table that, for a row
+    whose normalized email, item and permission references exist, refreshes its UPSERT_REFRESHED_COLUMNS instead, or does nothing on SQLite if
+    on_conflict is 'ignore'.
+    """
+
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES %s' % (
+        qn(UserPermission._meta.db_table),
+        ', '.join(qn(column) for column in UPSERT_COLUMNS),
+        ', '.join(['(%s)' % ', '.join(['%s'] * len(UPSERT_COLUMNS))] * row_count)
+    )
+
+    if connection.vendor == 'mysql':
+        # LAST_INSERT_ID(id) makes the cursor's lastrowid the ID of the existing row
+        return sql + ' ON DUPLICATE KEY UPDATE %s = LAST_INSERT_ID(%s), %s' % (
+            qn('id'), qn('id'), ', '.join('%s = VALUES(%s)' % (qn(column), qn(column)) for column in UPSERT_REFRESHED_COLUMNS)
+        )
+
+    conflict = 'ON CONFLICT (%s, %s, %s)' % (qn('normalized_email'), qn('item_ref_id'), qn('permission_ref_id'))
+    if on_conflict == 'ignore':
+        return sql + ' %s DO NOTHING' % conflict
+
+    return sql + ' %s DO UPDATE SET %s' % (
+        conflict, ', '.join('%s = excluded.%s' % (qn(column), qn(column)) for column in UPSERT_REFRESHED_COLUMNS)
+    )
+
+def _upsert_params(connection, rows, date_updated):
+    date_updated = UserPermission._meta.get_field('date_updated').get_db_prep_value(date_updated, connection)
+    item_ids = get_name_ids(Item, [item for email, item, permission in rows])
+    permission_ids = get_name_ids(PermissionType, [permission for email, item, permission in rows])
+
+    return [
+        value
+        for email, item, permission in rows
+        for value in (email, normalize_email(email), item, permission, item_ids[item], permission_ids[permission], date_updated)
+    ]
+
+def upsert_permission(email, item, permission):
+    """
+    Grants the permission on the item to the user, or refreshes the date_updated of their existing grant, with
+    a single INSERT ... ON DUPLICATE KEY UPDATE on MySQL. Returns the UserPermission and whether it was created.
+    The unique key is on the normalized email, so a grant to another case of an email refreshes the existing record.
+    """
+
+    connection = _get_connection()
+    date_updated = timezone.now()
+    params = _upsert_params(connection, [(email, item, permission)], date_updated)
+
+    # The record's fields as written by the upsert, and those refreshed on an existing grant
+    fields = dict(zip(UPSERT_COLUMNS, params), date_updated=date_updated)
+    refreshed = dict((column, fields[column]) for column in UPSERT_REFRESHED_COLUMNS)
+
+    if connection.vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(connection, 1, 'update'), params)
+
+            # One affected row for an insert and two for an update
+            created = cursor.rowcount == 1
+            record = UserPermission(id=cursor.lastrowid, **fields)
+
+    elif connection.vendor == 'sqlite':
+        # SQLite does not report whether an upsert inserted, so the insert ignores an existing grant
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(connection, 1, 'ignore'), params)
+            created = cursor.rowcount == 1
+
+        if created:
+            record = UserPermission(id=cursor.lastrowid, **fields)
+        else:
+            key = dict((column, fields[column]) for column in ('normalized_email', 'item_ref_id', 'permission_ref_id'))
+            UserPermission.objects.filter(**key).update(**refreshed)
+            record = UserPermission.objects.get(**key)
+
+    else:
+        with transaction.atomic():
+            record, created = UserPermission.objects.select_for_update().get_or_create(
+                normalized_email=fields['normalized_email'], item_ref_id=fields['item_ref_id'], permission_ref_id=fields['permission_ref_id'],
+                defaults={'user_email': email, 'item': item, 'permission': permission}
+            )
+            if not created:
+                for column, value in refreshed.items():
+                    setattr(record, column, value)
+                UserPermission.objects.filter(id=record.id).update(**refreshed)
+
+    # The insert does not send post_save. A refreshed date_updated changes the listings, but not the grants
+    # that the snapshot holds, so the snapshot is not rebuilt for it.
+    permissions_changed.send(sender=UserPermission, emails=[email], items=[item], grants_changed=created)
+
+    return record, created
+
+def upsert_permissions(rows):
+    """
+    Grants each (user_email, item, permission) row, or refreshes the date_updated of an existing grant, with
+    one statement per batch. Existing grants are never duplicated, even by concurrent requests or for
+    another case of the email.
+    """
+
+    batch_size = getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500)
+    connection = _get_connection()
+    date_updated = timezone.now()
+
+    if connection.vendor not in ('mysql', 'sqlite'):
+        for email, item, permission in rows:
+            upsert_permission(email, item, permission)
+        return
+
+    # SQLite accepts at most 999 parameters in a statement
+    if connection.vendor == 'sqlite':
+        batch_size = min(batch_size, 999 // len(UPSERT_COLUMNS))
+
+    with connection.cursor() as cursor:
+        for batch in _batches(rows, batch_size):
+            cursor.execute(_upsert_sql(connection, len(batch), 'update'), _upsert_params(connection, batch, date_updated))
+
+def grant_permissions(items, emails, permission):
+    """
+    Grants the permission on each of the items to every user in emails who does not already have it, or a
+    permission that implies it, in one transaction. Returns a dict keyed by item of the number of grants created and already present.
+    """
+
+    batch_size = getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500)
+
+    # Drop repeated grantees and items, which would otherwise be counted twice
+    emails = list(dict((normalize_email(email), email) for email in emails).values())
+    items = list(OrderedDict.fromkeys(items))
+
+    counts = {}
+    granted_emails = set()
+
+    with transaction.atomic():
+        for item in items:
+            existing = set()
+            for batch in _batches(emails, batch_size):
+                existing.update(UserPermission.objects.filter_names(
+                    items=[item],
+                    permissions=get_implying_permissions(permission)
+                ).filter(
+                    normalized_email__in=[normalize_email(email) for email in batch]
+                ).values_list('normalized_email', flat=True))
+
+            new_emails = [email for email in emails if normalize_email(email) not in existing]
+
+            upsert_permissions([(email, item, permission) for email in new_emails])
+
+            counts[item] = {'created': len(new_emails), 'existing': len(emails) - len(new_emails)}
+            granted_emails.update(new_emails)
+
+            logger.debug('[DEBUG][SCIAUTHZ][grant_permissions] - Created %s %s permissions on %s.', len(new_emails), permission, item)
+
+    # Upserts do not send post_save
+    permissions_changed.send(sender=UserPermission, emails=granted_emails, items=items)
+
+    return counts
+
+def _delete_records(record_ids, batch_size):
+    """
+    Deletes the UserPermission records with the given IDs with one DELETE per batch, and returns how many
+    there were. Deleting through the ORM would read them again and send post_delete, and bump the cached
+    versions, once for each record, so callers send permissions_changed once instead.
+    """
+
+    connection = _get_connection()
+    deleted = 0
+
+    with connection.cursor() as cursor:
+        for batch in _batches(record_ids, batch_size):
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                connection.ops.quote_name(UserPermission._meta.db_table), connection.ops.quote_name('id'), ', '.join(['%s'] * len(batch))
+            ), batch)
+            deleted += cursor.rowcount
+
+    return deleted
+
+def revoke_permissions(items, permission, emails=None):
+    """
+    Removes the permission on each of the items from every user in emails, or from everyone if emails is
+    None, in one transaction. Returns a dict keyed by item of the number of grants removed.
+    """
+
+    batch_size = getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500)
+
+    counts = {}
+    revoked_emails = set()
+
+    with transaction.atomic():
+        for item in items:
+            records = UserPermission.objects.filter_names(items=[item], permissions=[permission])
+            selections = [records] if emails is None else [
+                records.filter(normalized_email__in=[normalize_email(email) for email in batch]) for batch in _batches(emails, batch_size)
+            ]
+
+            # The records are locked as they are read, so those deleted are exactly those found
+            record_ids = []
+            for selection in selections:
+                for record_id, user_email in selection.select_for_update().values_list('id', 'user_email'):
+                    record_ids.append(record_id)
+                    revoked_emails.add(user_email)
+
+            counts[item] = _delete_records(record_ids, batch_size)
+
+            logger.debug('[DEBUG][SCIAUTHZ][revoke_permissions] - Removed %s %s permissions on %s.', counts[item], permission, item)
+
+    # The deletes do not send post_delete
+    permissions_changed.send(sender=UserPermission, emails=revoked_emails, items=items)
+
+    return counts
+
+def sync_permissions(item, emails, permission):
+    """
+    Makes the users in emails the only ones with the permission on the item, granting and removing it in
+    one transaction. Returns the emails of the users that were granted and that lost the permission.
+    Users with a permission that implies it already have it, as in grant_permissions, and only records
+    of the permission itself are removed.
+    """
+
+    batch_size = getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500)
+
+    # The desired and current grantees, keyed by normalized email
+    emails = dict((normalize_email(email), email) for email in emails)
+
+    with transaction.atomic():
+        # The current grants are locked as they are read, so the records removed are exactly those found
+        records = list(UserPermission.objects.filter_names(items=[item], permissions=get_implying_permissions(permission))
+                       .select_for_update().values_list('id', 'normalized_email', 'user_email', 'permission'))
+        holders = set(key for record_id, key, email, held in records)
+        records = [(record_id, key, email) for record_id, key, email, held in records if held == permission]
+        current = dict((key, email) for record_id, key, email in records)
+
+        added = [email for key, email in emails.items() if key not in holders]
+        removed = [email for key, email in current.items() if key not in emails]
+        stale_ids = [record_id for record_id, key, email in records if key not in emails]
+
+        upsert_permissions([(email, item, permission) for email in added])
+        _delete_records(stale_ids, batch_size)
+
+        logger.debug('[DEBUG][SCIAUTHZ][sync_permissions] - Added %s and removed %s %s permissions on %s.', len(added), len(removed), permission, item)
+
+    # Upserts do not send post_save, nor the deletes post_delete
+    stale_emails = [email for record_id, key, email in records if key not in emails]
+    permissions_changed.send(sender=UserPermission, emails=added + stale_emails, items=[item])
+
+    return {'added': sorted(added), 'removed': sorted(removed)}
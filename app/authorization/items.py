@@ -0,0 +1,32 @@
+# Items are dotted paths such as "SciReg.study1.profile". A grant on an item ending in the
+# wildcard, such as "SciReg.study1.*", covers every item below "SciReg.study1".
+ITEM_SEPARATOR = '.'
+ITEM_WILDCARD = '*'
+
+def is_prefix_item(item):
+    """
+    Returns whether the item is a prefix grant that covers other items.
+    """
+
+    return item.endswith(ITEM_SEPARATOR + ITEM_WILDCARD)
+
+def get_item_prefix(item):
+    """
+    Returns the path that every item covered by the prefix grant starts with, e.g. "SciReg.study1."
+    """
+
+    return item[:-len(ITEM_WILDCARD)]
+
+def get_item_scopes(item):
+    """
+    Returns the item followed by every prefix grant that covers it, from the most to the least specific.
+    For "SciReg.study1.profile" these are "SciReg.study1.profile", "SciReg.study1.*" and "SciReg.*".
+    A permission on an item is held if it is held on any of its scopes.
+    """
+
+    parts = item.split(ITEM_SEPARATOR)
+
+    # A prefix grant is not covered by itself a second time
+    depth = len(parts) - 2 if is_prefix_item(item) else len(parts) - 1
+
+    return [item] + [ITEM_SEPARATOR.join(parts[:index] + [ITEM_WILDCARD]) for index in range(depth, 0, -1)]
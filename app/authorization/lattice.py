@@ -0,0 +1,35 @@
+from django.conf import settings
+
+def get_permission_lattice():
+    """
+    Returns the PERMISSION_LATTICE setting, a dict of each permission and the permissions directly
+    below it, e.g. {"MANAGE": ["EDIT"], "EDIT": ["VIEW"]}.
+    """
+
+    return getattr(settings, 'PERMISSION_LATTICE', {})
+
+def get_implied_permissions(permission):
+    """
+    Returns the permission along with every permission it implies, directly or through others.
+    """
+
+    lattice = get_permission_lattice()
+
+    implied = set()
+    pending = [permission]
+    while pending:
+        current = pending.pop()
+        if current not in implied:
+            implied.add(current)
+            pending.extend(lattice.get(current, []))
+
+    return frozenset(implied)
+
+def get_implying_permissions(permission):
+    """
+    Returns the permission along with every permission that implies it.
+    """
+
+    lattice = get_permission_lattice()
+
+    return frozenset([permission] + [other for other in lattice if permission in get_implied_permissions(other)])
@@ -0,0 +1,59 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from authorization.models import UserPermission
+from authorization.models import normalize_email
+
+class Command(BaseCommand):
+    help = 'Sets the normalized_email of the UserPermission records that have none, a batch at a time with a ' \
+           'pause in between so the command can run against live traffic. A stopped run carries on where it ' \
+           'left off when started again, as only the records still missing a normalized_email are read.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Count the records to backfill without changing them.')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500),
+                            help='The number of records updated at a time.')
+        parser.add_argument('--sleep', type=float, default=0.1, help='The seconds to wait between batches.')
+        parser.add_argument('--all', action='store_true',
+                            help='Also check the records that have a normalized_email, and correct those that do not match '
+                                 'normalize_email, such as those backfilled with the database\'s TRIM and LOWER.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        records = UserPermission.objects.all() if options['all'] else UserPermission.objects.filter(normalized_email__isnull=True)
+        total = records.count()
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS('Found %s records to %s.' % (total, 'check' if options['all'] else 'backfill')))
+            return
+
+        # Records are read in order of ID, each batch starting after the last ID read
+        updated = 0
+        read = 0
+        last_id = 0
+        while True:
+            batch = list(records.filter(id__gt=last_id).order_by('id').values_list('id', 'user_email', 'normalized_email')[:batch_size])
+            if not batch:
+                break
+
+            # Normalized in Python, as the database's TRIM leaves tabs and newlines and SQLite's LOWER only lowers ASCII
+            ids_by_email = {}
+            for record_id, user_email, normalized_email in batch:
+                if normalized_email != normalize_email(user_email):
+                    ids_by_email.setdefault(normalize_email(user_email), []).append(record_id)
+
+            for normalized_email, ids in ids_by_email.items():
+                updated += UserPermission.objects.filter(id__in=ids).update(normalized_email=normalized_email)
+
+            read += len(batch)
+            last_id = batch[-1][0]
+
+            self.stdout.write('Backfilled %s records of the %s of %s read, up to ID %s.' % (updated, read, total, last_id))
+
+            if len(batch) == batch_size:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS('Backfilled %s records.' % updated))
@@ -0,0 +1,64 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from authorization.models import Item
+from authorization.models import PermissionType
+from authorization.models import UserPermission
+from authorization.models import get_name_ids
+from authorization.signals import permissions_changed
+
+class Command(BaseCommand):
+    help = 'Points the UserPermission records that are missing an item_ref or permission_ref at their Item and ' \
+           'PermissionType, a batch at a time with a pause in between so the command can run against live traffic. ' \
+           'A stopped run carries on where it left off when started again, as only the records still missing a ' \
+           'reference are read.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Count the records to backfill without changing them.')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500),
+                            help='The number of records updated at a time.')
+        parser.add_argument('--sleep', type=float, default=0.1, help='The seconds to wait between batches.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        records = UserPermission.objects.filter(Q(item_ref__isnull=True) | Q(permission_ref__isnull=True))
+        total = records.count()
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS('Found %s records to backfill.' % total))
+            return
+
+        # Records are read in order of ID, each batch starting after the last ID read
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(records.filter(id__gt=last_id).order_by('id').values_list('id', 'user_email', 'item', 'permission')[:batch_size])
+            if not batch:
+                break
+
+            item_ids = get_name_ids(Item, [item for record_id, email, item, permission in batch])
+            permission_ids = get_name_ids(PermissionType, [permission for record_id, email, item, permission in batch])
+
+            ids_by_name = {}
+            for record_id, email, item, permission in batch:
+                ids_by_name.setdefault((item, permission), []).append(record_id)
+
+            for (item, permission), ids in ids_by_name.items():
+                updated += UserPermission.objects.filter(id__in=ids).update(item_ref_id=item_ids[item], permission_ref_id=permission_ids[permission])
+
+            # Lookups go through the references, so these records were missing from the cached permissions
+            permissions_changed.send(sender=UserPermission, emails=[email for record_id, email, item, permission in batch],
+                                     items=[item for item, permission in ids_by_name])
+
+            last_id = batch[-1][0]
+
+            self.stdout.write('Backfilled %s of %s records, up to ID %s.' % (updated, total, last_id))
+
+            if len(batch) == batch_size:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS('Backfilled %s records.' % updated))
@@ -0,0 +1,473 @@
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import reset_queries
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from rest_framework.test import force_authenticate
+
+from authorization.cache import PermissionCache
+from authorization.cache import load_permission_sets
+from authorization.cache import permission_cache
+from authorization.models import Item
+from authorization.models import UserPermission
+from authorization.models import clear_name_ids
+from authorization.signals import permissions_changed
+from authorization.snapshot import PermissionSnapshot
+from authorization.snapshot import build_snapshot
+
+# Every record the benchmark creates is on an item under one of these prefixes
+BENCHMARK_ITEM_PREFIX = 'Bench.'
+BENCHMARK_PROFILE_PREFIX = 'SciReg.Bench.'
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic dataset of UserPermission records on Bench. items and times the permission ' \
+           'queries and API actions against it, reporting latency percentiles and query counts as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000, help='The number of users in the dataset.')
+        parser.add_argument('--items', type=int, default=1000, help='The number of items in the dataset.')
+        parser.add_argument('--grants', type=int, default=1000000, help='The number of VIEW grants to spread over the items.')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='The Zipf exponent of the grants per item: the item ranked n gets a share proportional to 1/n^skew.')
+        parser.add_argument('--profile-fraction', type=float, default=0.1,
+                            help='The fraction of grants that also get a SciReg profile record for the item\'s manager.')
+        parser.add_argument('--iterations', type=int, default=200, help='The number of timed runs of each scenario.')
+        parser.add_argument('--cold', action='store_true', help='Clear the per-process permission cache before each run.')
+        parser.add_argument('--seed', type=int, default=0, help='The seed of the random dataset and samples.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='The number of records inserted or deleted at a time.')
+        parser.add_argument('--output', default=None, help='The JSON file the results are written to.')
+        parser.add_argument('--reuse', action='store_true', help='Benchmark the Bench. records already in the database.')
+        parser.add_argument('--keep', action='store_true', help='Leave the Bench. records in the database afterwards.')
+        parser.add_argument('--cleanup', action='store_true', help='Only remove the Bench. records.')
+        parser.add_argument('--snapshot', action='store_true',
+                            help='Also compare the memory and check times of the permission snapshot and the per-worker caches.')
+        parser.add_argument('--workers', type=int, default=4, help='The number of workers that map the snapshot with --snapshot.')
+        parser.add_argument('--i-know-this-is-not-production', action='store_true',
+                            help='Run with DEBUG off. The benchmark inserts and deletes up to millions of records.')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['i_know_this_is_not_production']:
+            raise CommandError('DEBUG is off, so this may be a production database. The benchmark inserts and deletes '
+                               'up to millions of records; give --i-know-this-is-not-production to run it anyway.')
+
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        if options['cleanup']:
+            self.remove_dataset()
+            return
+
+        if not options['reuse']:
+            self.remove_dataset()
+            self.generate_dataset(options)
+
+        try:
+            samples = self.load_samples()
+
+            # The requests are made in process as the test client makes them, from its host
+            with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+                results = self.run_scenarios(samples, options['iterations'], options['cold'])
+
+            snapshot_results = self.measure_snapshot(samples, options['iterations'], options['workers']) if options['snapshot'] else None
+        finally:
+            if not options['keep'] and not options['reuse']:
+                self.remove_dataset()
+
+        report = {
+            'date': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'options': dict((key, options[key]) for key in ('users', 'items', 'grants', 'skew', 'profile_fraction', 'iterations', 'cold', 'seed', 'reuse')),
+            'dataset': samples['counts'],
+            'results': results,
+        }
+
+        if snapshot_results is not None:
+            report['snapshot'] = snapshot_results
+
+        output = options['output'] or 'benchmark-permissions-%s.json' % timezone.now().strftime('%Y%m%d%H%M%S')
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        self.stdout.write('%-48s %10s %10s %10s %10s' % ('scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for name in sorted(results):
+            result = results[name]
+            self.stdout.write('%-48s %10.2f %10.2f %10.2f %10.1f' % (name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['queries_mean']))
+
+        if snapshot_results is not None:
+            self.stdout.write('')
+            for key in sorted(snapshot_results):
+                self.stdout.write('%-48s %s' % (key, snapshot_results[key]))
+
+        self.stdout.write(self.style.SUCCESS('Wrote the results to %s.' % output))
+
+    def benchmark_records(self):
+        return UserPermission.objects.filter(Q(item__startswith=BENCHMARK_ITEM_PREFIX) | Q(item__startswith=BENCHMARK_PROFILE_PREFIX))
+
+    def generate_dataset(self, options):
+        """
+        Creates one manager per 20 items with MANAGE on each of their items, the VIEW grants spread over the items
+        with a Zipf distribution, and SciReg profile records for the managers on a fraction of those grants.
+        """
+
+        users = ['bench-user%06d@example.org' % i for i in range(options['users'])]
+        items = ['%sitem%05d' % (BENCHMARK_ITEM_PREFIX, i) for i in range(options['items'])]
+        managers = ['bench-manager%04d@example.org' % i for i in range(max(1, len(items) // 20))]
+
+        weights = [1.0 / (rank ** options['skew']) for rank in range(1, len(items) + 1)]
+        total_weight = sum(weights)
+
+        records = []
+        created = 0
+
+        def flush():
+            UserPermission.objects.bulk_create(records)
+            return len(records)
+
+        for index, item in enumerate(items):
+            manager = managers[index % len(managers)]
+            records.append(UserPermission(user_email=manager, item=item, permission='MANAGE'))
+
+            grant_count = min(len(users), max(1, int(round(options['grants'] * weights[index] / total_weight))))
+            for user in self.random.sample(users, grant_count):
+                records.append(UserPermission(user_email=user, item=item, permission='VIEW'))
+
+                if self.random.random() < options['profile_fraction']:
+                    profile = 'SciReg.%s.profile.%s' % (item, user)
+                    records.append(UserPermission(user_email=manager, item=profile, permission='VIEW'))
+
+                if len(records) >= self.batch_size:
+                    created += flush()
+                    records = []
+
+            self.stdout.write('Generated %s records.' % (created + len(records)))
+
+        created += flush()
+        self.stdout.write('Generated %s records.' % created)
+
+        # bulk_create does not send post_save, so the cached permissions of the users are invalidated here
+        permissions_changed.send(sender=UserPermission, emails=set(users + managers), items=set(items))
+
+    def remove_dataset(self):
+        removed = 0
+        emails = set()
+        items = set()
+
+        while True:
+            batch = list(self.benchmark_records().order_by('id').values_list('id', 'user_email', 'item')[:self.batch_size])
+            if not batch:
+                break
+
+            removed += self.delete_ids(UserPermission, [record[0] for record in batch])
+
+            emails.update(record[1] for record in batch)
+            items.update(record[2] for record in batch if record[2].startswith(BENCHMARK_ITEM_PREFIX))
+
+        if removed:
+            permissions_changed.send(sender=UserPermission, emails=emails, items=items)
+
+        # The records are gone, so nothing references the benchmark's Items any more
+        while True:
+            batch = list(Item.objects.filter(Q(name__startswith=BENCHMARK_ITEM_PREFIX) | Q(name__startswith=BENCHMARK_PROFILE_PREFIX))
+                         .filter(permissions__isnull=True).values_list('id', flat=True)[:self.batch_size])
+            if not batch:
+                break
+
+            self.delete_ids(Item, batch)
+
+        clear_name_ids()
+
+        self.stdout.write('Removed %s benchmark records.' % removed)
+
+    def delete_ids(self, model, ids):
+        """
+        Deletes the model's records with the given IDs with a single DELETE and returns how many there were.
+        Deleting through the ORM would send post_delete, and bump the cached versions, once for each record.
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (connection.ops.quote_name(model._meta.db_table), ', '.join(['%s'] * len(ids))), ids)
+            return cursor.rowcount
+
+    def load_samples(self):
+        """
+        Reads the items with their managers and a sample of their grantees, and counts the dataset.
+        """
+
+        item_managers = dict(UserPermission.objects.filter(item__startswith=BENCHMARK_ITEM_PREFIX, permission='MANAGE')
+                             .values_list('item', 'user_email'))
+
+        if not item_managers:
+            raise ValueError('There are no benchmark records. Run the benchmark without --reuse first.')
+
+        items = sorted(item_managers)
+        grantees = {}
+        for item in self.random.sample(items, min(len(items), 100)):
+            grantees[item] = list(UserPermission.objects.filter(item=item, permission='VIEW')
+                                  .values_list('user_email', flat=True)[:50])
+
+        grants = self.benchmark_records().filter(item__startswith=BENCHMARK_ITEM_PREFIX, permission='VIEW').count()
+        counts = {
+            'records': self.benchmark_records().count(),
+            'total_records': UserPermission.objects.count(),
+            'items': len(items),
+            'managers': len(set(item_managers.values())),
+            'grants': grants,
+        }
+
+        return {'item_managers': item_managers, 'grantees': dict((item, emails) for item, emails in grantees.items() if emails), 'counts': counts}
+
+    def run_scenarios(self, samples, iterations, cold):
+        from authorization.views import UserPermissionViewSet
+        from authorization.views import get_authorized_user_permissions
+
+        factory = APIRequestFactory()
+        item_managers = samples['item_managers']
+        sampled_items = sorted(samples['grantees'])
+
+        def pick():
+            item = self.random.choice(sampled_items)
+            return item, item_managers[item], self.random.choice(samples['grantees'][item])
+
+        def call(action, method, email, path='/user_permission/', data=None):
+            make_request = factory.get if method == 'get' else factory.post
+            request = make_request(path, data or {})
+            force_authenticate(request, user=User(username=email, email=email), token={'email': email})
+
+            response = UserPermissionViewSet.as_view({method: action})(request)
+            response.render()
+            return str(response.status_code)
+
+        list_view = lambda email, **params: call('list', 'get', email, data=params)
+        new_grantees = ('bench-new%06d@example.org' % i for i in range(iterations * 10))
+
+        scenarios = []
+
+        def scenario(name):
+            def register(run):
+                scenarios.append((name, run))
+                return run
+            return register
+
+        @scenario('get_authorized_user_permissions (own)')
+        def own_permissions():
+            item, manager, grantee = pick()
+            list(get_authorized_user_permissions(grantee))
+
+        @scenario('get_authorized_user_permissions (manager, item)')
+        def managed_item_permissions():
+            item, manager, grantee = pick()
+            list(get_authorized_user_permissions(manager, item=item))
+
+        @scenario('get_authorized_user_permissions (manager, user)')
+        def managed_user_permissions():
+            item, manager, grantee = pick()
+            list(get_authorized_user_permissions(manager, requested_user=grantee))
+
+        @scenario('list (own)')
+        def list_own():
+            item, manager, grantee = pick()
+            return list_view(grantee)
+
+        @scenario('list (manager, item)')
+        def list_item():
+            item, manager, grantee = pick()
+            return list_view(manager, item=item)
+
+        @scenario('check (MANAGE, other user)')
+        def check_other_user():
+            item, manager, grantee = pick()
+            return call('check', 'get', manager, '/user_permission/check/', {'item': item, 'permission': 'VIEW', 'email': grantee})
+
+        @scenario('check (MANAGE, not a manager)')
+        def check_not_manager():
+            item, manager, grantee = pick()
+            return call('check', 'get', grantee, '/user_permission/check/', {'item': item, 'permission': 'MANAGE', 'email': manager})
+
+        @scenario('create + remove_item_view_permission_record')
+        def create_and_remove():
+            item, manager, grantee = pick()
+            data = {'item': item, 'grantee_email': next(new_grantees)}
+            created = call('create_item_view_permission_record', 'post', manager, '/user_permission/create_item_view_permission_record/', data)
+            removed = call('remove_item_view_permission_record', 'post', manager, '/user_permission/remove_item_view_permission_record/', data)
+            return '%s/%s' % (created, removed)
+
+        results = {}
+        for name, run in scenarios:
+            durations = []
+            queries = []
+            outcomes = {}
+
+            for i in range(iterations):
+                if cold:
+                    permission_cache.clear()
+
+                # The captured queries are counted from the connection's log, which only holds the latest 9000
+                reset_queries()
+
+                with CaptureQueriesContext(connection) as context:
+                    started = time.perf_counter()
+                    outcome = run()
+                    durations.append((time.perf_counter() - started) * 1000)
+
+                queries.append(len(context.captured_queries))
+
+                # The API scenarios return the status codes of their responses
+                if outcome is not None:
+                    outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+
+            results[name] = self.summarize(durations, queries, outcomes)
+
+        return results
+
+    def measure_snapshot(self, samples, iterations, workers):
+        """
+        Compares the memory the per-worker caches take to hold every user's permissions with the memory
+        the snapshot takes in each of the given number of workers mapping it, and the times of their checks.
+        """
+
+        directory = tempfile.mkdtemp(prefix='sciauthz-snapshot-')
+        path = os.path.join(directory, 'permissions.snapshot')
+
+        try:
+            started = time.perf_counter()
+            version, keys = build_snapshot(path)
+            results = {
+                'snapshot_build_s': time.perf_counter() - started,
+                'snapshot_keys': keys,
+                'snapshot_file_bytes': os.path.getsize(path),
+            }
+
+            # The permissions of every user, as a worker's cache holds them once it has seen them all
+            emails = sorted(set(self.benchmark_records().values_list('normalized_email', flat=True)))
+            cache = PermissionCache(max_size=len(emails), ttl=3600)
+
+            tracemalloc.start()
+            for start in range(0, len(emails), self.batch_size):
+                versions = dict((email, 0) for email in emails[start:start + self.batch_size])
+                for email, permission_set in load_permission_sets(versions).items():
+                    cache.set(email, permission_set)
+            cache_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            max_size = getattr(settings, 'PERMISSION_CACHE_MAX_SIZE', 10000)
+            results.update({
+                'cache_users': len(emails),
+                'cache_bytes_all_users': cache_bytes,
+                'cache_bytes_per_user': cache_bytes // max(1, len(emails)),
+                'cache_bytes_per_worker_at_max_size': cache_bytes * min(len(emails), max_size) // max(1, len(emails)),
+            })
+
+            results.update(self.measure_snapshot_workers(path, workers))
+
+            # The time of a check from each, both already in memory
+            snapshot = PermissionSnapshot(path)
+            checks = []
+            for i in range(iterations):
+                item = self.random.choice(sorted(samples['grantees']))
+                checks.append((self.random.choice(samples['grantees'][item]), item))
+
+            started = time.perf_counter()
+            for email, item in checks:
+                cache.get(email).has_permission(item, 'VIEW')
+            results['cache_check_us'] = (time.perf_counter() - started) / len(checks) * 1000000
+
+            started = time.perf_counter()
+            for email, item in checks:
+                snapshot.has_permission(email, item, 'VIEW')
+            results['snapshot_check_us'] = (time.perf_counter() - started) / len(checks) * 1000000
+
+            return results
+        finally:
+            shutil.rmtree(directory)
+
+    def measure_snapshot_workers(self, path, workers):
+        """
+        Forks workers that each map the snapshot and read all of it, and returns the resident and proportional
+        set sizes of the mapping in each worker, read from /proc/self/smaps while they are all running.
+        """
+
+        if not os.path.exists('/proc/self/smaps'):
+            return {}
+
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(workers)
+        sizes = context.Queue()
+
+        def worker():
+            snapshot = PermissionSnapshot(path)
+            for offset in range(0, len(snapshot.data), mmap.PAGESIZE):
+                snapshot.data[offset]
+
+            barrier.wait()
+            sizes.put(read_mapping_sizes(path))
+            barrier.wait()
+
+        processes = [context.Process(target=worker) for i in range(workers)]
+        for process in processes:
+            process.start()
+
+        measured = [sizes.get() for process in processes]
+        for process in processes:
+            process.join()
+
+        return {
+            'snapshot_workers': workers,
+            'snapshot_rss_bytes_per_worker': max(rss for rss, pss in measured),
+            'snapshot_pss_bytes_per_worker': max(pss for rss, pss in measured),
+            'snapshot_pss_bytes_all_workers': sum(pss for rss, pss in measured),
+        }
+
+    def summarize(self, durations, queries, outcomes):
+        durations = sorted(durations)
+
+        def percentile(fraction):
+            return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+
+        return {
+            'iterations': len(durations),
+            'mean_ms': sum(durations) / len(durations),
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': durations[-1],
+            'queries_mean': sum(queries) / float(len(queries)),
+            'queries_max': max(queries),
+            'statuses': outcomes,
+        }
+
+def read_mapping_sizes(path):
+    """
+    Returns the resident and proportional set sizes in bytes of this process's mappings of the file.
+    """
+
+    rss = pss = 0
+    in_mapping = False
+
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            fields = line.split()
+            if not line[0].isupper() or not fields[0].endswith(':'):
+                # The first line of each mapping is its address range, ending with the mapped file
+                in_mapping = fields[-1] == os.path.realpath(path)
+            elif in_mapping and fields[0] == 'Rss:':
+                rss += int(fields[1]) * 1024
+            elif in_mapping and fields[0] == 'Pss:':
+                pss += int(fields[1]) * 1024
+
+    return rss, pss
@@ -0,0 +1,86 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from authorization.models import UserPermission
+from authorization.models import normalize_email
+
+class Command(BaseCommand):
+    help = 'Merges UserPermission records that grant the same item and permission to case variants of the same email, ' \
+           'keeping the most recently updated one, so that migration 0028 can move the unique key to the normalized email. ' \
+           'Records are removed a few at a time with a pause in between so the command can run against live traffic, ' \
+           'and a run can be stopped and started again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the duplicate records without removing them.')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500),
+                            help='The number of duplicated grants compacted at a time.')
+        parser.add_argument('--sleep', type=float, default=0.5, help='The seconds to wait between batches.')
+        parser.add_argument('--resume-from', default=None,
+                            help='Only compact the grants of this email and those after it, as printed by an earlier run.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        duplicates = UserPermission.objects.all()
+        if options['resume_from']:
+            duplicates = duplicates.filter(normalized_email__gte=normalize_email(options['resume_from']))
+
+        duplicates = list(duplicates.values('normalized_email', 'item', 'permission')
+                          .annotate(records=Count('id'))
+                          .filter(records__gt=1)
+                          .order_by('normalized_email', 'item', 'permission')
+                          .values_list('normalized_email', 'item', 'permission'))
+
+        self.stdout.write('Found %s duplicated grants.' % len(duplicates))
+
+        stale_count = 0
+        for start in range(0, len(duplicates), batch_size):
+            batch = duplicates[start:start + batch_size]
+
+            stale = self.find_stale_records(batch)
+            for record in stale:
+                self.stdout.write('%s %s %s %s' % record)
+            stale_count += len(stale)
+
+            if stale and not options['dry_run']:
+                # Deleting through the ORM sends post_delete, which invalidates each record's cached permissions
+                UserPermission.objects.filter(id__in=[record[0] for record in stale]).delete()
+
+            # A stopped run can pick up again from the email of the batch's last grant, which may have more in the next batch
+            self.stdout.write('Compacted %s of %s duplicated grants, up to %s.' % (start + len(batch), len(duplicates), batch[-1][0]))
+
+            if not options['dry_run'] and start + batch_size < len(duplicates):
+                time.sleep(options['sleep'])
+
+        action = 'Found' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS('%s %s duplicate records.' % (action, stale_count)))
+
+    def find_stale_records(self, duplicates):
+        """
+        Returns the (id, user_email, item, permission) records of the given (email, item, permission) grants other
+        than the most recently updated record of each.
+        """
+
+        duplicates = set(duplicates)
+
+        records = UserPermission.objects\
+            .filter(normalized_email__in=set(email for email, item, permission in duplicates))\
+            .order_by('-date_updated', '-id')\
+            .values_list('id', 'normalized_email', 'user_email', 'item', 'permission')
+
+        kept = set()
+        stale = []
+        for record_id, email, user_email, item, permission in records:
+            grant = (email, item, permission)
+            if grant not in duplicates:
+                continue
+
+            if grant in kept:
+                stale.append((record_id, user_email, item, permission))
+            else:
+                kept.add(grant)
+
+        return stale
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from authorization.items import get_item_scopes
+from authorization.lattice import get_implying_permissions
+from authorization.models import UserPermission
+from authorization.models import normalize_email
+
+class Command(BaseCommand):
+    help = 'Removes UserPermission records that are implied by another record of the same user, through the ' \
+           'permission lattice or a prefix grant, e.g. a VIEW record on an item the user also has MANAGE on.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the redundant records without removing them.')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500),
+                            help='The number of users whose records are read, and of records removed, at a time.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Only users with more than one record can have redundant ones
+        emails = list(UserPermission.objects.values('normalized_email')
+                      .annotate(records=Count('id'))
+                      .filter(records__gt=1)
+                      .values_list('normalized_email', flat=True))
+
+        redundant_count = 0
+        for start in range(0, len(emails), batch_size):
+            batch = emails[start:start + batch_size]
+
+            records = UserPermission.objects.filter(normalized_email__in=batch).values_list('id', 'user_email', 'item', 'permission')
+            redundant = self.find_redundant_records(records)
+
+            for record in redundant:
+                self.stdout.write('%s %s %s %s' % record)
+            redundant_count += len(redundant)
+
+            # Deleting through the ORM sends post_delete, which invalidates the cached permissions of each record's user
+            if redundant and not options['dry_run']:
+                UserPermission.objects.filter(id__in=[record[0] for record in redundant]).delete()
+
+        action = 'Found' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS('%s %s redundant records.' % (action, redundant_count)))
+
+    def find_redundant_records(self, records):
+        """
+        Returns the (id, user_email, item, permission) records covered by another record of the same user.
+        """
+
+        owned = {}
+        for record_id, user_email, item, permission in records:
+            owned.setdefault(normalize_email(user_email), set()).add((item, permission))
+
+        redundant = []
+        for record_id, user_email, item, permission in records:
+            covering = set(
+                (scope, other_permission)
+                for scope in get_item_scopes(item)
+                for other_permission in get_implying_permissions(permission)
+            )
+            covering.discard((item, permission))
+
+            if covering & owned[normalize_email(user_email)]:
+                redundant.append((record_id, user_email, item, permission))
+
+        return redundant
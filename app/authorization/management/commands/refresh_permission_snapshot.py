@@ -0,0 +1,64 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+
+from authorization.cache import get_change_version
+from authorization.checks import PROCESS_LOCAL_CACHE_BACKENDS
+from authorization.snapshot import build_snapshot
+from authorization.snapshot import read_snapshot_version
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Builds the permission snapshot that workers answer checks from and moves it into place. With ' \
+           '--watch, keeps running and rebuilds it whenever a permission has changed since it was built, ' \
+           'waiting longer between rebuilds the longer they take.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None, help='The snapshot file, PERMISSION_SNAPSHOT_PATH by default.')
+        parser.add_argument('--watch', action='store_true', help='Rebuild the snapshot whenever permissions change.')
+        parser.add_argument('--interval', type=float, default=5, help='The seconds between checks for changes with --watch.')
+        parser.add_argument('--backoff', type=float, default=5,
+                            help='With --watch, wait at least this many times as long as a rebuild took before the next one.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or getattr(settings, 'PERMISSION_SNAPSHOT_PATH', None)
+        if not path:
+            raise CommandError('Set PERMISSION_SNAPSHOT_PATH or give a --path.')
+
+        if not options['watch']:
+            self.refresh(path)
+            return
+
+        # The workers bump the change version in their own cache, which this process would never see
+        alias = getattr(settings, 'PERMISSION_SHARED_CACHE_ALIAS', 'default')
+        if settings.CACHES.get(alias, {}).get('BACKEND') in PROCESS_LOCAL_CACHE_BACKENDS:
+            raise CommandError('The %s cache is kept in each process, so the snapshot cannot follow changes made by the workers.' % alias)
+
+        next_refresh = 0
+        while True:
+            # The database may have closed an idle connection between rounds
+            close_old_connections()
+
+            try:
+                if time.monotonic() >= next_refresh and read_snapshot_version(path) != get_change_version():
+                    duration = self.refresh(path)
+
+                    # Under steady writes the table is then read in full for at most a share of the time
+                    next_refresh = time.monotonic() + duration * options['backoff']
+            except Exception as e:
+                logger.exception('[SCIAUTHZ][refresh_permission_snapshot] - Could not refresh the snapshot: %s', e)
+
+            time.sleep(options['interval'])
+
+    def refresh(self, path):
+        started = time.perf_counter()
+        version, count = build_snapshot(path)
+        duration = time.perf_counter() - started
+
+        self.stdout.write('Wrote %s keys at version %s to %s in %.2fs.' % (count, version, path, duration))
+        return duration
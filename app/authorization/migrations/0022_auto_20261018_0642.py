@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 06:42
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Max
+
+BATCH_SIZE = 10000
+
+def remove_duplicate_permissions(apps, schema_editor):
+    """
+    The unique constraint cannot be added while duplicate grants exist, so only keep the
+    most recently updated record for each (user_email, item, permission). Each statement deletes
+    the records in a range of IDs that have a more recently updated record of the same grant (or,
+    updated at the same time, a newer one), so no statement locks much of the table however many
+    duplicates there are.
+    """
+
+    UserPermission = apps.get_model("authorization", "userpermission")
+
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+
+    names = dict(
+        table=qn(UserPermission._meta.db_table), newer=qn('newer'),
+        id=qn('id'), user_email=qn('user_email'), item=qn('item'), permission=qn('permission'), date_updated=qn('date_updated'),
+    )
+
+    if connection.vendor == 'mysql':
+        # MySQL cannot read the table a DELETE removes from in a subquery, so the newer records are joined
+        names['stale'] = qn('stale')
+        sql = 'DELETE {stale} FROM {table} AS {stale} INNER JOIN {table} AS {newer} ON {condition} ' \
+              'WHERE {stale}.{id} > %s AND {stale}.{id} <= %s'
+    else:
+        names['stale'] = names['table']
+        sql = 'DELETE FROM {table} WHERE {id} > %s AND {id} <= %s ' \
+              'AND EXISTS (SELECT 1 FROM {table} AS {newer} WHERE {condition})'
+
+    condition = '{newer}.{user_email} = {stale}.{user_email} AND {newer}.{item} = {stale}.{item} ' \
+                'AND {newer}.{permission} = {stale}.{permission} AND ({newer}.{date_updated} > {stale}.{date_updated} ' \
+                'OR ({newer}.{date_updated} = {stale}.{date_updated} AND {newer}.{id} > {stale}.{id}))'.format(**names)
+    sql = sql.format(condition=condition, **names)
+
+    last_id = UserPermission.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    with connection.cursor() as cursor:
+        for start in range(0, last_id, BATCH_SIZE):
+            cursor.execute(sql, [start, start + BATCH_SIZE])
+
+class Migration(migrations.Migration):
+
+    # Each range is committed as it is cleaned
+    atomic = False
+
+    dependencies = [
+        ('authorization', '0021_remove_userpermission_user'),
+    ]
+
+    operations = [
+        # The index is built first, so the duplicates of each record are found through it
+        migrations.AlterIndexTogether(
+            name='userpermission',
+            index_together=set([('user_email', 'permission', 'item'), ('item', 'permission')]),
+        ),
+        migrations.RunPython(remove_duplicate_permissions, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='userpermission',
+            unique_together=set([('user_email', 'item', 'permission')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 07:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0022_auto_20261018_0642'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userpermission',
+            name='normalized_email',
+            field=models.CharField(blank=True, editable=False, max_length=250, null=True, verbose_name='Normalized Email'),
+        ),
+        migrations.AlterIndexTogether(
+            name='userpermission',
+            index_together=set([('normalized_email', 'permission', 'item'), ('item', 'permission')]),
+        ),
+    ]
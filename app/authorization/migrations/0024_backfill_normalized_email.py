@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+def normalize_email(email):
+    # As authorization.models.normalize_email was when this migration was written
+    return email.strip().lower()
+
+def backfill_normalized_email(apps, schema_editor):
+    """
+    Sets the normalized_email of every record that has none, a chunk at a time so that no statement locks
+    much of the table. On a large table, run the backfill_normalized_emails command before this migration
+    and only the records written since are left for it.
+    """
+
+    UserPermission = apps.get_model("authorization", "userpermission")
+
+    last_id = 0
+    while True:
+        records = list(UserPermission.objects.filter(id__gt=last_id, normalized_email__isnull=True)
+                       .order_by('id').values_list('id', 'user_email')[:1000])
+        if not records:
+            break
+
+        # Normalized in Python, as the database's TRIM leaves tabs and newlines and SQLite's LOWER only lowers ASCII
+        ids_by_email = {}
+        for record_id, user_email in records:
+            ids_by_email.setdefault(normalize_email(user_email), []).append(record_id)
+
+        for normalized_email, ids in ids_by_email.items():
+            UserPermission.objects.filter(id__in=ids).update(normalized_email=normalized_email)
+        last_id = records[-1][0]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0023_userpermission_normalized_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_normalized_email, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Max
+
+BATCH_SIZE = 1000
+
+def backfill_permission_refs(apps, schema_editor):
+    """
+    Creates an Item and a PermissionType for every name in use, then points each record at them, a range of
+    IDs at a time so that no statement locks much of the table. Records that already reference both are
+    skipped, so the migration can be run again after it is stopped.
+    """
+
+    Item = apps.get_model("authorization", "item")
+    PermissionType = apps.get_model("authorization", "permissiontype")
+    UserPermission = apps.get_model("authorization", "userpermission")
+
+    for model, field in ((Item, 'item'), (PermissionType, 'permission')):
+        existing = set(model.objects.values_list('name', flat=True))
+        names = UserPermission.objects.order_by().values_list(field, flat=True).distinct()
+        model.objects.bulk_create([model(name=name) for name in names if name not in existing], batch_size=BATCH_SIZE)
+
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+
+    # Each reference is looked up by a subquery on the unique name, so a batch is a single statement
+    sql = 'UPDATE {records} SET {item_ref} = (SELECT {id} FROM {items} WHERE {items}.{name} = {records}.{item}), ' \
+          '{permission_ref} = (SELECT {id} FROM {permissions} WHERE {permissions}.{name} = {records}.{permission}) ' \
+          'WHERE {id} > %s AND {id} <= %s AND ({item_ref} IS NULL OR {permission_ref} IS NULL)'.format(
+              records=qn(UserPermission._meta.db_table),
+              items=qn(Item._meta.db_table),
+              permissions=qn(PermissionType._meta.db_table),
+              id=qn('id'), name=qn('name'), item=qn('item'), permission=qn('permission'),
+              item_ref=qn('item_ref_id'), permission_ref=qn('permission_ref_id'),
+          )
+
+    last_id = UserPermission.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    with connection.cursor() as cursor:
+        for start in range(0, last_id, BATCH_SIZE):
+            cursor.execute(sql, [start, start + BATCH_SIZE])
+
+class Migration(migrations.Migration):
+
+    # Each batch is committed as it is made
+    atomic = False
+
+    dependencies = [
+        ('authorization', '0025_item_permissiontype'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_permission_refs, migrations.RunPython.noop),
+    ]
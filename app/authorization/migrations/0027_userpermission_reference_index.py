@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 08:23
+from __future__ import unicode_literals
+
+import importlib
+
+from django.db import migrations
+
+def backfill_permission_refs(apps, schema_editor):
+    """
+    Points the records written without references since 0026, by processes still running the code from
+    before it, at their Item and PermissionType. Lookups now go through the references.
+    """
+
+    importlib.import_module('authorization.migrations.0026_backfill_permission_refs').backfill_permission_refs(apps, schema_editor)
+
+class Migration(migrations.Migration):
+
+    # Each batch of the backfill is committed as it is made
+    atomic = False
+
+    dependencies = [
+        ('authorization', '0026_backfill_permission_refs'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_permission_refs, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='userpermission',
+            index_together=set([('item', 'permission'), ('normalized_email', 'item_ref', 'permission_ref')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 08:39
+from __future__ import unicode_literals
+
+import importlib
+
+from django.db import migrations
+from django.db.models import Count
+
+def check_no_case_duplicates(apps, schema_editor):
+    """
+    Fills in the normalized_email of records written without one, then stops the migration if grants to case
+    variants of the same email are still to be merged, as the unique key could not be added over them.
+    """
+
+    importlib.import_module('authorization.migrations.0024_backfill_normalized_email').backfill_normalized_email(apps, schema_editor)
+
+    UserPermission = apps.get_model("authorization", "userpermission")
+
+    duplicates = UserPermission.objects.values('normalized_email', 'item', 'permission')\
+        .annotate(records=Count('id')).filter(records__gt=1).order_by().count()
+
+    if duplicates:
+        raise RuntimeError('Found %s grants held by more than one case of an email. Run the '
+                           'compact_duplicate_permissions command, then migrate again.' % duplicates)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authorization', '0027_userpermission_reference_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_no_case_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='userpermission',
+            unique_together=set([('normalized_email', 'item', 'permission')]),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 08:42
+from __future__ import unicode_literals
+
+import importlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+def backfill_permission_refs(apps, schema_editor):
+    """
+    Points any records still written without references, by processes running the code from before 0026,
+    at their Item and PermissionType, so that the references can be made required. On a large table, run
+    the backfill_permission_refs command first and only the records written since are left for this.
+    """
+
+    importlib.import_module('authorization.migrations.0026_backfill_permission_refs').backfill_permission_refs(apps, schema_editor)
+
+class Migration(migrations.Migration):
+
+    # Each batch of the backfill is committed as it is made
+    atomic = False
+
+    dependencies = [
+        ('authorization', '0028_userpermission_normalized_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_permission_refs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='userpermission',
+            name='item_ref',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='permissions', to='authorization.Item'),
+        ),
+        migrations.AlterField(
+            model_name='userpermission',
+            name='permission_ref',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='permissions', to='authorization.PermissionType'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userpermission',
+            unique_together=set([('normalized_email', 'item_ref', 'permission_ref')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userpermission',
+            index_together=set([('item_ref', 'permission_ref')]),
+        ),
+    ]
@@ -1,4 +1,6 @@
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.core.exceptions import ValidationError
@@ -22,14 +24,149 @@ class UserPermissionRequest(models.Model):
     def __str__(self):
         return '%s %s %s' % (self.user, self.item, self.request_granted)
 
+class Item(models.Model):
+    """
+    An item that permissions are granted on, such as a project or a SciReg profile.
+    """
+    name = models.CharField(max_length=100, unique=True, blank=False, null=False, verbose_name="Name")
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+class PermissionType(models.Model):
+    """
+    A permission that can be granted on an item, such as VIEW or MANAGE.
+    """
+    name = models.CharField(max_length=100, unique=True, blank=False, null=False, verbose_name="Name")
+
+    def __str__(self):
+        return self.name
+
+# The IDs of the Items and PermissionTypes by name, which do not change once committed
+_name_ids = {}
+
+def get_name_ids(model, names):
+    """
+    Returns a dict of the IDs of the Item or PermissionType records with the given names, creating
+    those that do not exist yet.
+    """
+
+    names = set(names)
+    ids = dict((name, _name_ids[model, name]) for name in names if (model, name) in _name_ids)
+
+    missing = names - set(ids)
+    if missing:
+        def find(names):
+            names = sorted(names)
+            found = {}
+            for start in range(0, len(names), 500):
+                found.update(model.objects.filter(name__in=names[start:start + 500]).values_list('name', 'id'))
+            return found
+
+        found = find(missing)
+
+        new_names = missing - set(found)
+        if new_names:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([model(name=name) for name in new_names])
+            except IntegrityError:
+                # Another request created some of them first, so those left are created one at a time
+                pass
+
+            found.update(find(new_names))
+            for name in new_names - set(found):
+                found[name] = model.objects.get_or_create(name=name)[0].id
+
+        ids.update(found)
+
+        # A record created in a transaction that is rolled back must not be remembered
+        transaction.on_commit(lambda: _name_ids.update(((model, name), record_id) for name, record_id in found.items()))
+
+    return ids
+
+def clear_name_ids():
+    """
+    Forgets the remembered IDs of every Item and PermissionType, as must be done after any are deleted.
+    """
+
+    _name_ids.clear()
+
+def normalize_email(email):
+    """
+    Returns the form of an email that UserPermission records are looked up by, so that any case or
+    surrounding whitespace of an email matches the same records.
+    """
+    return email.strip().lower()
+
+class UserPermissionQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create does not call save(), so the records are normalized here
+        objs = list(objs)
+        item_ids = get_name_ids(Item, [obj.item for obj in objs])
+        permission_ids = get_name_ids(PermissionType, [obj.permission for obj in objs])
+
+        for obj in objs:
+            obj.normalized_email = normalize_email(obj.user_email)
+            obj.item_ref_id = item_ids[obj.item]
+            obj.permission_ref_id = permission_ids[obj.permission]
+
+        return super(UserPermissionQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def update(self, **kwargs):
+        # Lookups go through the references, so they must follow a change of the names
+        if 'item' in kwargs:
+            kwargs['item_ref_id'] = get_name_ids(Item, [kwargs['item']])[kwargs['item']]
+        if 'permission' in kwargs:
+            kwargs['permission_ref_id'] = get_name_ids(PermissionType, [kwargs['permission']])[kwargs['permission']]
+
+        return super(UserPermissionQuerySet, self).update(**kwargs)
+
+    def filter_names(self, items=None, permissions=None):
+        """
+        Returns the records of any of the given items and permissions. They are matched by reference, the names
+        being looked up once in a subquery on the unique Item and PermissionType names.
+        """
+
+        records = self
+        if items is not None:
+            records = records.filter(item_ref__in=Item.objects.filter(name__in=list(items)))
+        if permissions is not None:
+            records = records.filter(permission_ref__in=PermissionType.objects.filter(name__in=list(permissions)))
+
+        return records
+
 class UserPermission(models.Model):
     """
     This is the granting of permission to a user for a specific project.
     """
     user_email = models.CharField(max_length=250, blank=False, null=False, verbose_name="User Email")
+    normalized_email = models.CharField(max_length=250, blank=True, null=True, editable=False, verbose_name="Normalized Email")
     item = models.CharField(max_length=100, blank=False, null=False, verbose_name="Item")
     permission = models.CharField(max_length=100, blank=False, null=False, verbose_name="Permission")
     date_updated = models.DateTimeField(blank=False, null=False, auto_now_add=True)
 
+    # The item and permission as records, which every lookup goes through. The names are kept for the API.
+    item_ref = models.ForeignKey(Item, editable=False, on_delete=models.PROTECT, related_name='permissions')
+    permission_ref = models.ForeignKey(PermissionType, editable=False, on_delete=models.PROTECT, related_name='permissions')
+
+    class Meta:
+        # A user holds a given permission on an item at most once, whatever the case of their email. The key
+        # also serves the lookups of a user's permissions.
+        unique_together = (('normalized_email', 'item_ref', 'permission_ref'),)
+
+        # Match the lookups of the grants on an item
+        index_together = (('item_ref', 'permission_ref'),)
+
+    objects = UserPermissionQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.user_email)
+        self.item_ref_id = get_name_ids(Item, [self.item])[self.item]
+        self.permission_ref_id = get_name_ids(PermissionType, [self.permission])[self.permission]
+        super(UserPermission, self).save(*args, **kwargs)
+
     def __str__(self):
         return '%s %s %s' % (self.user_email, self.item, self.permission)
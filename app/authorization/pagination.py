@@ -0,0 +1,127 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor
+from rest_framework.pagination import CursorPagination
+from rest_framework.pagination import _reverse_ordering
+
+class UserPermissionCursorPagination(CursorPagination):
+    """
+    Keyset pagination of UserPermission records. Each page starts after the last record of the one before
+    rather than counting and offsetting rows, so every page costs the same however deep a client goes.
+    Records are ordered by id, or with ?ordering=date_updated by their last update and then id.
+
+    DRF's CursorPagination only keeps the first field of the ordering in its cursors and steps over ties with
+    an offset, which it caps. A bulk grant gives all of its records the same date_updated, so here the cursor
+    holds every field of the ordering, which together are unique, and pages never need an offset.
+    """
+
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    orderings = {
+        'id': ('id',),
+        'date_updated': ('date_updated', 'id'),
+    }
+    ordering = orderings['id']
+
+    # Separates the values of the ordering's fields in a position
+    position_separator = '|'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+
+        return self.page_size
+
+    def get_ordering(self, request, queryset, view):
+        return self.orderings.get(request.query_params.get('ordering'), self.ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        current_position = self.cursor.position if self.cursor is not None else None
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self.get_position_filter(queryset.model, current_position, reverse))
+
+        # One record more than the page tells whether there is another page after it
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following_position = len(results) > len(self.page)
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None
+            self.has_previous = has_following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        # An empty page going backwards has nothing before the position it started from
+        position = self._get_position_from_instance(self.page[-1], self.ordering) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+
+        position = self._get_position_from_instance(self.page[0], self.ordering) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def get_position_filter(self, model, position, reverse):
+        """
+        Returns the filter for the records after the position in the ordering, or before it if reverse: those
+        greater in the first field, or equal in it and greater in the second, and so on.
+        """
+
+        values = position.split(self.position_separator)
+        if len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        try:
+            values = [model._meta.get_field(field).to_python(value) for field, value in zip(self.ordering, values)]
+        except ValidationError:
+            raise NotFound(self.invalid_cursor_message)
+
+        lookup = 'lt' if reverse else 'gt'
+
+        position_filter = None
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            after = Q(**dict(equal, **{'%s__%s' % (field, lookup): value}))
+            position_filter = after if position_filter is None else position_filter | after
+            equal[field] = value
+
+        return position_filter
+
+    def _get_position_from_instance(self, instance, ordering):
+        return self.position_separator.join(
+            (value.isoformat() if hasattr(value, 'isoformat') else str(value))
+            for value in (instance[field] if isinstance(instance, dict) else getattr(instance, field) for field in ordering)
+        )
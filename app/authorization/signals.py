@@ -0,0 +1,39 @@
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import Signal
+from django.dispatch import receiver
+
+from authorization.cache import invalidate_permissions
+from authorization.models import Item
+from authorization.models import PermissionType
+from authorization.models import UserPermission
+from authorization.models import clear_name_ids
+
+# Sent after UserPermissions are created or deleted in bulk, which does not send post_save or post_delete.
+# grants_changed is False when existing grants only had their date_updated refreshed.
+permissions_changed = Signal(providing_args=['emails', 'items', 'grants_changed'])
+
+@receiver([post_save, post_delete], sender=UserPermission)
+def invalidate_cached_permissions(sender, instance, **kwargs):
+    """
+    Invalidates the cached permissions of the user and item whose UserPermission changed.
+    """
+
+    invalidate_permissions(emails=[instance.user_email], items=[instance.item])
+
+@receiver(permissions_changed, sender=UserPermission)
+def invalidate_bulk_changed_permissions(sender, emails, items, grants_changed=True, **kwargs):
+    """
+    Invalidates the cached permissions of the users and items changed in bulk.
+    """
+
+    invalidate_permissions(emails=emails, items=items, grants_changed=grants_changed)
+
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=PermissionType)
+def forget_deleted_name_ids(sender, instance, **kwargs):
+    """
+    Forgets the remembered IDs, which may include the deleted record's.
+    """
+
+    clear_name_ids()
@@ -0,0 +1,281 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from authorization.cache import get_change_version
+from authorization.cache import get_changed_emails
+from authorization.cache import get_permission_sets
+from authorization.items import get_item_scopes
+from authorization.lattice import get_implied_permissions
+from authorization.models import UserPermission
+from authorization.models import normalize_email
+from SciAuthZ.metrics import CACHE_LOOKUPS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A snapshot file is a header followed by the sorted keys of every (email, item, permission) a user holds,
+# including the permissions implied by the permission lattice. A key is a 64-bit hash of the normalized
+# email, a 64-bit hash of the item and a 32-bit hash of the permission, so every record has the same width.
+SNAPSHOT_MAGIC = b'SCIAUTHZ'
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct('>8sHQQ')
+SNAPSHOT_RECORD_SIZE = 20
+
+def _hash(value, size):
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=size).digest()
+
+def get_email_key(email):
+    return _hash(normalize_email(email), 8)
+
+def get_record_key(email_key, item, permission):
+    """
+    Returns the key of a record, big-endian so that the keys sort bytewise.
+    """
+
+    return email_key + _hash(item, 8) + _hash(permission, 4)
+
+def write_snapshot(path, records, version):
+    """
+    Writes a snapshot of the (email, item, permission) records, built at the given change version, to a new
+    file and moves it into place, so that workers mapping the old file never see a partly written one.
+    Returns the number of keys written.
+    """
+
+    keys = set()
+    for email, item, permission in records:
+        email_key = get_email_key(email)
+        keys.update(get_record_key(email_key, item, implied) for implied in get_implied_permissions(permission))
+
+    keys = sorted(keys)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.snapshot-', delete=False) as f:
+        try:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, len(keys), version))
+            f.write(b''.join(keys))
+            f.flush()
+            os.fsync(f.fileno())
+            os.chmod(f.name, 0o644)
+        except Exception:
+            os.unlink(f.name)
+            raise
+
+    os.replace(f.name, path)
+
+    return len(keys)
+
+def build_snapshot(path):
+    """
+    Writes a snapshot of every UserPermission record to the path. The change version is read before the
+    records, so a change made while they are read leaves the snapshot at an older version than the current one.
+    Returns the version and the number of keys written.
+    """
+
+    version = get_change_version()
+    chunk_size = 10000
+
+    def iterate_records():
+        last_id = 0
+        while True:
+            chunk = list(UserPermission.objects.filter(id__gt=last_id).order_by('id')
+                         .values_list('id', 'user_email', 'item', 'permission')[:chunk_size])
+
+            for record_id, user_email, item, permission in chunk:
+                yield user_email, item, permission
+
+            if len(chunk) < chunk_size:
+                return
+
+            last_id = chunk[-1][0]
+
+    return version, write_snapshot(path, iterate_records(), version)
+
+def read_snapshot_version(path):
+    """
+    Returns the change version the snapshot at the path was built at, or None if there is none.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            magic, snapshot_format, count, version = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    except (IOError, struct.error):
+        return None
+
+    return version if magic == SNAPSHOT_MAGIC and snapshot_format == SNAPSHOT_FORMAT else None
+
+class PermissionSnapshot(object):
+    """
+    A snapshot file mapped read-only into memory. Every worker that maps the file shares the same pages
+    of the operating system's page cache, so the snapshot is held in memory once however many workers use it.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The file is replaced rather than changed, so a new inode or modification time means a new snapshot
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+
+        magic, snapshot_format, self.count, self.version = SNAPSHOT_HEADER.unpack(self.data[:SNAPSHOT_HEADER.size])
+        if magic != SNAPSHOT_MAGIC or snapshot_format != SNAPSHOT_FORMAT:
+            raise ValueError('%s is not a permission snapshot.' % path)
+        if len(self.data) != SNAPSHOT_HEADER.size + self.count * SNAPSHOT_RECORD_SIZE:
+            raise ValueError('The permission snapshot %s is truncated.' % path)
+
+    def contains(self, key):
+        """
+        Returns whether the record key is in the snapshot, by a binary search of the sorted keys.
+        """
+
+        data = self.data
+        low = 0
+        high = self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = SNAPSHOT_HEADER.size + middle * SNAPSHOT_RECORD_SIZE
+            record = data[offset:offset + SNAPSHOT_RECORD_SIZE]
+
+            if record < key:
+                low = middle + 1
+            elif record > key:
+                high = middle
+            else:
+                return True
+
+        return False
+
+    def has_permission(self, email, item, permission):
+        email_key = get_email_key(email)
+        return any(self.contains(get_record_key(email_key, scope, permission)) for scope in get_item_scopes(item))
+
+class SnapshotPermissionSet(object):
+    """
+    Answers the checks of a PermissionSet for one user from a PermissionSnapshot.
+    """
+
+    __slots__ = ('snapshot', 'email')
+
+    def __init__(self, snapshot, email):
+        self.snapshot = snapshot
+        self.email = email
+
+    def has_permission(self, item, permission):
+        return self.snapshot.has_permission(self.email, item, permission)
+
+    def manages(self, item):
+        return self.snapshot.has_permission(self.email, item, 'MANAGE')
+
+class SnapshotReader(object):
+    """
+    Maps the snapshot at PERMISSION_SNAPSHOT_PATH, looking for a new file at most every
+    PERMISSION_SNAPSHOT_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.path = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the current PermissionSnapshot, or None if snapshots are off or there is none yet.
+        """
+
+        path = getattr(settings, 'PERMISSION_SNAPSHOT_PATH', None)
+        if not path:
+            return None
+
+        now = time.monotonic()
+        interval = getattr(settings, 'PERMISSION_SNAPSHOT_CHECK_INTERVAL', 1)
+        if path == self.path and self.checked_at is not None and now - self.checked_at < interval:
+            return self.snapshot
+
+        with self._lock:
+            self.checked_at = now
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.path, self.snapshot = path, None
+                return None
+
+            # A snapshot replaced here is unmapped once no check is still reading it
+            if path != self.path or self.snapshot is None or self.snapshot.identity != (stat.st_ino, stat.st_mtime_ns):
+                try:
+                    self.snapshot = PermissionSnapshot(path)
+                except (OSError, ValueError) as e:
+                    logger.warning('[SCIAUTHZ][SnapshotReader] - Could not map the permission snapshot: %s', e)
+                    self.snapshot = None
+                self.path = path
+
+            return self.snapshot
+
+snapshot_reader = SnapshotReader()
+
+class ChangedUsers(object):
+    """
+    The users whose grants changed since the version a snapshot was built at, read from the change log in
+    the shared cache. The worker remembers those read so far, so each check only reads the changes since the last.
+    """
+
+    def __init__(self):
+        self.snapshot_version = None
+        self.version = None
+        self.emails = frozenset()
+        self._lock = threading.Lock()
+
+    def get(self, snapshot_version, version):
+        """
+        Returns the normalized emails of the users changed after snapshot_version up to version, or None if
+        the change log does not cover them all.
+        """
+
+        with self._lock:
+            if snapshot_version != self.snapshot_version or version < self.version:
+                self.snapshot_version, self.version, self.emails = snapshot_version, snapshot_version, frozenset()
+
+            if version > self.version:
+                emails = get_changed_emails(self.version, version)
+                if emails is None:
+                    return None
+
+                self.version, self.emails = version, self.emails | emails
+
+            return self.emails
+
+changed_users = ChangedUsers()
+
+def get_check_permission_sets(emails):
+    """
+    Returns a dict keyed by normalized email of objects that answer has_permission and manages for the
+    users. Users whose grants have not changed since the permission snapshot was built are answered from
+    it, and the others, or everyone if the change log does not reach back to the snapshot, from their PermissionSets.
+    """
+
+    emails = set(normalize_email(email) for email in emails)
+
+    snapshot = snapshot_reader.get()
+    if snapshot is not None:
+        changed = changed_users.get(snapshot.version, get_change_version())
+        if changed is not None:
+            current = emails - changed
+            CACHE_LOOKUPS.labels('snapshot', 'hit').inc(len(current))
+            CACHE_LOOKUPS.labels('snapshot', 'miss').inc(len(emails) - len(current))
+
+            permission_sets = get_permission_sets(emails & changed) if emails & changed else {}
+            permission_sets.update((email, SnapshotPermissionSet(snapshot, email)) for email in current)
+            return permission_sets
+
+        CACHE_LOOKUPS.labels('snapshot', 'miss').inc(len(emails))
+
+    return get_permission_sets(emails)
@@ -3,17 +3,48 @@ from furl import furl
 from pprint import pprint
 from unittest.mock import patch
 
+import base64
+import hashlib
+import io
 import json
+import os
+import shutil
+import tempfile
+import time
+
+import jwt
 
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
 from rest_framework.test import APITestCase
 from rest_framework.test import APIClient
+from rest_framework.test import APIRequestFactory
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+from authorization.cache import PermissionCache
+from authorization.cache import get_permission_set
+from authorization.cache import get_user_version
+from authorization.cache import invalidate_permissions
+from authorization.cache import permission_cache
+from authorization.items import get_item_scopes
+from authorization.lattice import get_implied_permissions
+from authorization.lattice import get_implying_permissions
 from authorization.models import UserPermission
+from authorization.pagination import UserPermissionCursorPagination
 
 FAKE_ITEM_1 = "Sci.Test"
 FAKE_ITEM_2 = "SciAuthZ.Test"
@@ -42,6 +73,10 @@ class UserPermissionTest(APITestCase):
         The necessary steps before tests can run.
         """
 
+        # Cached permissions are not rolled back with each test's transaction.
+        permission_cache.clear()
+        cache.clear()
+
         # Create a user to force an accepted authentication on all requests. This will not necessarily
         # always be the user we want to assume is sending the requests, so the individual tests below
         # will mock the requesting user as necessary.
@@ -142,7 +177,7 @@ class UserPermissionTest(APITestCase):
         )
         perm3 = UserPermission.objects.create(
             user_email=USER_EMAIL,
-            item=FAKE_ITEM_2,
+            item=FAKE_ITEM_3,
             permission="VIEW"
         )
 
@@ -164,6 +199,596 @@ class UserPermissionTest(APITestCase):
         response = self.client.get(f.url)
         self.assertEqual(response.data['count'], 0)
 
+    def test_get_permissions_query_count_is_constant(self):
+        """
+        Test that filtering the records a user may see is done in the database, so the number
+        of queries does not depend on how many grants an item has.
+        """
+
+        from authorization.views import get_authorized_user_permissions
+
+        def count_queries(grant_count):
+            permission_cache.clear()
+            cache.clear()
+            UserPermission.objects.filter(item=FAKE_ITEM_1, permission="VIEW").delete()
+            UserPermission.objects.bulk_create([
+                UserPermission(user_email="grantee%s@example.org" % i, item=FAKE_ITEM_1, permission="VIEW")
+                for i in range(grant_count)
+            ])
+
+            # A user who neither owns nor manages any of these grants
+            with CaptureQueriesContext(connection) as context:
+                records = list(get_authorized_user_permissions(OTHER_USER_EMAIL, item=FAKE_ITEM_1))
+            self.assertEqual(len(records), 0)
+
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(10), count_queries(2000))
+
+        # With a cold cache, one query loads the requesting user's permissions and one filters the records
+        self.assertEqual(count_queries(10), 2)
+
+        # Once their permissions are cached, only the records are queried
+        with self.assertNumQueries(1):
+            list(get_authorized_user_permissions(OTHER_USER_EMAIL, item=FAKE_ITEM_1))
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_get_permissions_not_modified(self, get_email_from_jwt):
+        """
+        Test that listing permissions again with the ETag of the last response gets a 304 without a body, until
+        the permissions change.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+        f = furl("/user_permission/")
+        f.args["item"] = FAKE_ITEM_1
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.data["count"], 2)
+        etag = response["ETag"]
+
+        # The records are not queried, nor counted, when the ETag matches
+        with self.assertNumQueries(0):
+            response = self.client.get(f.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b'')
+
+        # * only matches a listing that succeeds
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Another user asking for the same URL gets their own ETag
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # A new permission on the item changes the ETag
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        UserPermission.objects.create(user_email=OTHER_USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 3)
+
+        # A page that does not exist is not turned into a 304
+        f.args["page"] = 5
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn("ETag", response)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_check_permission_not_modified(self, get_email_from_jwt):
+        """
+        Test that an allowed check is answered with a 304 when its ETag still matches, and that a denied check
+        is always answered with a 403, even when If-None-Match matches.
+        """
+
+        from authorization.views import get_permission_etag
+
+        f = furl("/user_permission/check/")
+        f.args["item"] = FAKE_ITEM_2
+        f.args["permission"] = "VIEW"
+
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn("ETag", response)
+
+        # The ETag the check would have if it were allowed
+        etag = get_permission_etag(APIRequestFactory().get(f.url), [USER_EMAIL])
+        for if_none_match in (etag, "*"):
+            response = self.client.get(f.url, HTTP_IF_NONE_MATCH=if_none_match)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # A new permission for the user makes the check allowed and gives it an ETag
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(f.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_get_permissions_with_cursor_pagination(self, get_email_from_jwt):
+        """
+        Test paging through the permissions on an item with keyset pagination, which does not count the records.
+        """
+
+        UserPermission.objects.bulk_create([
+            UserPermission(user_email="grantee%s@example.org" % i, item=FAKE_ITEM_1, permission="VIEW")
+            for i in range(24)
+        ])
+
+        f = furl("/user_permission/")
+        f.args["item"] = FAKE_ITEM_1
+        f.args["pagination"] = "cursor"
+        f.args["page_size"] = 10
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        get_permission_set(MANAGER_EMAIL)
+
+        ids = []
+        url = f.url
+        while url:
+            # Every page is a single query
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn("count", response.data)
+
+            ids.extend(record["id"] for record in response.data["results"])
+            url = response.data["next"]
+
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(ids, sorted(ids))
+
+        # Records updated at the same time, as by a bulk grant, are paged by ID without repeats or an offset cap
+        UserPermission.objects.bulk_create([
+            UserPermission(user_email="tied%s@example.org" % i, item=FAKE_ITEM_1, permission="VIEW")
+            for i in range(1201)
+        ])
+        UserPermission.objects.filter(item=FAKE_ITEM_1).update(date_updated=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        UserPermission.objects.filter(item=FAKE_ITEM_1, user_email="grantee0@example.org").update(date_updated=datetime(2021, 1, 1, tzinfo=timezone.utc))
+
+        f.args["ordering"] = "date_updated"
+        f.args["page_size"] = 200
+
+        ids = []
+        pages = []
+        url = f.url
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            pages.append(response.data)
+            ids.extend(record["id"] for record in response.data["results"])
+            url = response.data["next"]
+
+        all_ids = list(UserPermission.objects.filter(item=FAKE_ITEM_1).order_by("date_updated", "id").values_list("id", flat=True))
+        self.assertEqual(len(pages), 7)
+        self.assertEqual(ids, all_ids)
+
+        # Going back from the last page gives the same pages in reverse
+        back_ids = list(reversed([record["id"] for record in pages[-1]["results"]]))
+        url = pages[-1]["previous"]
+        while url:
+            response = self.client.get(url)
+            back_ids.extend(reversed([record["id"] for record in response.data["results"]]))
+            url = response.data["previous"]
+        self.assertEqual(back_ids, list(reversed(all_ids)))
+
+        del f.args["ordering"]
+
+        # Page sizes are capped
+        f.args["page_size"] = 100000
+        with patch.object(UserPermissionCursorPagination, "max_page_size", 20):
+            response = self.client.get(f.url)
+        self.assertEqual(len(response.data["results"]), 20)
+
+        # Without opting in, the response is paginated by page number as before
+        del f.args["pagination"]
+        response = self.client.get(f.url)
+        self.assertEqual(response.data["count"], 1226)
+        self.assertEqual(len(response.data["results"]), 10)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_check_permission(self, get_email_from_jwt):
+        """
+        Test checking whether a user has a permission on an item. Users can check themselves, and
+        managers can check other users on the items they manage.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+        f = furl("/user_permission/check/")
+        f.args["item"] = FAKE_ITEM_1
+        f.args["permission"] = "VIEW"
+
+        # The user has the permission
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b'')
+
+        # Once their permissions are cached, no queries are needed
+        with self.assertNumQueries(0):
+            response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # The user does not have another permission
+        f.args["permission"] = "MANAGE"
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # The manager can check the user's permissions on the item they manage
+        f.args["permission"] = "VIEW"
+        f.args["email"] = USER_EMAIL
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # But another user cannot
+        get_email_from_jwt.return_value = OTHER_USER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # The item and permission are required
+        del f.args["permission"]
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_batch_check_permissions(self, get_email_from_jwt):
+        """
+        Test checking several permissions at once. A manager can check anyone on the items they
+        manage, but only themselves on other items.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+
+        data = {
+            "checks": [
+                {"item": FAKE_ITEM_1, "permission": "MANAGE"},
+                {"item": FAKE_ITEM_2, "permission": "VIEW"},
+                {"item": FAKE_ITEM_3, "permission": "VIEW"},
+                {"item": FAKE_ITEM_1, "permission": "VIEW", "email": USER_EMAIL},
+                {"item": FAKE_ITEM_1, "permission": "VIEW", "email": OTHER_USER_EMAIL},
+                {"item": FAKE_ITEM_2, "permission": "VIEW", "email": USER_EMAIL},
+            ]
+        }
+
+        # Every user's permissions are loaded with a single query
+        with self.assertNumQueries(1):
+            response = self.client.post("/user_permission/batch_check/", data, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [True, True, False, True, False, False])
+
+        # The batch size is limited
+        with self.settings(PERMISSION_CHECK_BATCH_LIMIT=5):
+            response = self.client.post("/user_permission/batch_check/", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Every field of a check must be a string
+        for check in ({"item": FAKE_ITEM_1, "permission": "VIEW", "email": None},
+                      {"item": FAKE_ITEM_1, "permission": "VIEW", "email": 42},
+                      {"item": [FAKE_ITEM_1], "permission": "VIEW"},
+                      {"item": FAKE_ITEM_1, "permission": {"name": "VIEW"}}):
+            response = self.client.post("/user_permission/batch_check/", {"checks": [check]}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_export_permissions(self, get_email_from_jwt):
+        """
+        Test streaming all the permissions on an item as NDJSON and as CSV, which only its managers can do.
+        """
+
+        UserPermission.objects.bulk_create([
+            UserPermission(user_email="grantee%s@example.org" % i, item=FAKE_ITEM_1, permission="VIEW")
+            for i in range(1200)
+        ])
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+
+        f = furl("/user_permission/export/")
+        f.args["item"] = FAKE_ITEM_1
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        response = self.client.get(f.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        records = [json.loads(line) for line in b"".join(response.streaming_content).decode("utf-8").splitlines()]
+        self.assertEqual(len(records), 1201)
+        self.assertEqual(records[0]["user_email"], MANAGER_EMAIL)
+        self.assertEqual([record["id"] for record in records], sorted(record["id"] for record in records))
+
+        f.args["output"] = "csv"
+        response = self.client.get(f.url)
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual(rows[0], "id,user_email,item,permission,date_updated")
+        self.assertEqual(len(rows), 1202)
+
+        # A user without MANAGE permissions cannot export the item
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_item_scopes(self):
+        """
+        Test the prefix grants that cover an item.
+        """
+
+        self.assertEqual(get_item_scopes("SciReg.study1.profile"), ["SciReg.study1.profile", "SciReg.study1.*", "SciReg.*"])
+        self.assertEqual(get_item_scopes("SciReg.study1.*"), ["SciReg.study1.*", "SciReg.*"])
+        self.assertEqual(get_item_scopes("SciReg"), ["SciReg"])
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_prefix_permissions(self, get_email_from_jwt):
+        """
+        Test that a permission on a prefix grant covers every item below it.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item="SciReg.study1.*", permission="VIEW")
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item="SciReg.*", permission="MANAGE")
+        UserPermission.objects.create(user_email=OTHER_USER_EMAIL, item="SciReg.study2.profile", permission="VIEW")
+
+        f = furl("/user_permission/check/")
+        f.args["permission"] = "VIEW"
+
+        get_email_from_jwt.return_value = USER_EMAIL
+        for item, expected_status in (("SciReg.study1.profile", status.HTTP_200_OK),
+                                      ("SciReg.study1.profile.user@example.com", status.HTTP_200_OK),
+                                      ("SciReg.study1", status.HTTP_403_FORBIDDEN),
+                                      ("SciReg.study2.profile", status.HTTP_403_FORBIDDEN)):
+            f.args["item"] = item
+            self.assertEqual(self.client.get(f.url).status_code, expected_status)
+
+        # The manager of the namespace can list and grant permissions on any item in it
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+
+        f = furl("/user_permission/")
+        f.args["email"] = OTHER_USER_EMAIL
+        response = self.client.get(f.url)
+        self.assertEqual(response.data["count"], 1)
+
+        data = {"grantee_email": OTHER_USER_EMAIL, "item": "SciReg.study1.*"}
+        response = self.client.post("/user_permission/create_item_view_permission_record/", data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_permission_lattice(self):
+        """
+        Test the permissions implied by and implying others.
+        """
+
+        self.assertEqual(get_implied_permissions("MANAGE"), {"MANAGE", "EDIT", "VIEW"})
+        self.assertEqual(get_implied_permissions("VIEW"), {"VIEW"})
+        self.assertEqual(get_implying_permissions("VIEW"), {"MANAGE", "EDIT", "VIEW"})
+        self.assertEqual(get_implying_permissions("MANAGE"), {"MANAGE"})
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_implied_permissions(self, get_email_from_jwt):
+        """
+        Test that a MANAGE record answers VIEW checks without a VIEW record, and that redundant VIEW
+        records are found and removed.
+        """
+
+        f = furl("/user_permission/check/")
+        f.args["item"] = FAKE_ITEM_1
+        f.args["permission"] = "VIEW"
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        self.assertEqual(self.client.get(f.url).status_code, status.HTTP_200_OK)
+
+        # Bulk grants skip users who already have the permission through another
+        response = self.client.post(
+            "/user_permission/bulk_create_item_view_permission_records/",
+            {"grantee_emails": [MANAGER_EMAIL], "item": FAKE_ITEM_1},
+            format="json"
+        )
+        self.assertEqual(response.data["existing"], 1)
+
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.create(user_email=USER_EMAIL, item="SciReg.*", permission="VIEW")
+        UserPermission.objects.create(user_email=USER_EMAIL, item="SciReg.study1", permission="VIEW")
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+        call_command("prune_redundant_permissions", dry_run=True, stdout=io.StringIO())
+        self.assertEqual(UserPermission.objects.count(), 5)
+
+        call_command("prune_redundant_permissions", stdout=io.StringIO())
+        self.assertEqual(
+            set(UserPermission.objects.values_list("user_email", "item", "permission")),
+            {(MANAGER_EMAIL, FAKE_ITEM_1, "MANAGE"), (USER_EMAIL, "SciReg.*", "VIEW"), (USER_EMAIL, FAKE_ITEM_1, "VIEW")}
+        )
+
+    def test_compact_duplicate_permissions_command(self):
+        """
+        Test that records for case variants of the same email are merged down to the most recently updated one.
+        """
+
+        existing = set(UserPermission.objects.values_list("id", flat=True))
+
+        # The duplicates were written under the unique key on user_email from before migration 0028
+        with connection.schema_editor() as editor:
+            editor.alter_unique_together(UserPermission, UserPermission._meta.unique_together, [("user_email", "item", "permission")])
+
+        older = UserPermission.objects.create(user_email=USER_EMAIL.upper(), item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.filter(id=older.id).update(date_updated=timezone.now() - timezone.timedelta(days=1))
+        newer = UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.create(user_email=USER_EMAIL.title(), item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.filter(id=newer.id).update(date_updated=timezone.now() + timezone.timedelta(days=1))
+        other = UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+
+        call_command("compact_duplicate_permissions", dry_run=True, stdout=io.StringIO())
+        self.assertEqual(UserPermission.objects.count(), len(existing) + 4)
+
+        output = io.StringIO()
+        call_command("compact_duplicate_permissions", batch_size=1, sleep=0, stdout=output)
+        self.assertIn("Removed 2 duplicate records.", output.getvalue())
+        self.assertEqual(set(UserPermission.objects.values_list("id", flat=True)), existing | {newer.id, other.id})
+
+        # Running it again finds nothing left to do
+        output = io.StringIO()
+        call_command("compact_duplicate_permissions", resume_from=USER_EMAIL, stdout=output)
+        self.assertIn("Found 0 duplicated grants.", output.getvalue())
+
+        # Once compacted, the unique key can be moved to the normalized email, which rules out new case variants
+        with connection.schema_editor() as editor:
+            editor.alter_unique_together(UserPermission, [("user_email", "item", "permission")], UserPermission._meta.unique_together)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserPermission.objects.create(user_email=USER_EMAIL.upper(), item=FAKE_ITEM_2, permission="VIEW")
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_permission_snapshot(self, get_email_from_jwt):
+        """
+        Test that checks are answered from the snapshot without querying the database, including permissions
+        implied by the lattice and prefix grants, and from the database for users whose permissions changed since it was built.
+        """
+
+        from authorization.snapshot import snapshot_reader
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item="SciReg.*", permission="MANAGE")
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "permissions.snapshot")
+
+        with self.settings(PERMISSION_SNAPSHOT_PATH=path, PERMISSION_SNAPSHOT_CHECK_INTERVAL=0):
+            call_command("refresh_permission_snapshot", stdout=io.StringIO())
+
+            snapshot = snapshot_reader.get()
+            self.assertTrue(snapshot.has_permission(USER_EMAIL.upper(), "SciReg.study1.profile", "VIEW"))
+            self.assertTrue(snapshot.has_permission(MANAGER_EMAIL, FAKE_ITEM_1, "EDIT"))
+            self.assertFalse(snapshot.has_permission(MANAGER_EMAIL, FAKE_ITEM_2, "VIEW"))
+
+            f = furl("/user_permission/check/")
+            f.args["item"] = FAKE_ITEM_1
+            f.args["permission"] = "VIEW"
+            f.args["email"] = OTHER_USER_EMAIL
+
+            get_email_from_jwt.return_value = MANAGER_EMAIL
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(f.url).status_code, status.HTTP_403_FORBIDDEN)
+            self.assertEqual(len(context.captured_queries), 0)
+
+            # Once a user's permissions change, they are checked against the database until the snapshot is rebuilt
+            UserPermission.objects.create(user_email=OTHER_USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+            self.assertEqual(self.client.get(f.url).status_code, status.HTTP_200_OK)
+
+            # Everyone else is still checked against the snapshot
+            own = furl("/user_permission/check/")
+            own.args["item"] = "SciReg.study1.profile"
+            own.args["permission"] = "VIEW"
+
+            get_email_from_jwt.return_value = USER_EMAIL
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(own.url).status_code, status.HTTP_200_OK)
+            self.assertEqual(len(context.captured_queries), 0)
+
+            # Unless the change log no longer reaches back to the snapshot
+            from authorization.cache import _change_key
+            from authorization.cache import get_change_version
+
+            UserPermission.objects.create(user_email="someone@example.org", item=FAKE_ITEM_2, permission="VIEW")
+            cache.delete(_change_key(get_change_version()))
+            permission_cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(own.url).status_code, status.HTTP_200_OK)
+            self.assertEqual(len(context.captured_queries), 1)
+
+            get_email_from_jwt.return_value = MANAGER_EMAIL
+
+            call_command("refresh_permission_snapshot", stdout=io.StringIO())
+            self.assertNotEqual(snapshot_reader.get(), snapshot)
+
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(f.url).status_code, status.HTTP_200_OK)
+            self.assertEqual(len(context.captured_queries), 0)
+
+            # Granting the permission again only refreshes its date_updated, which leaves the snapshot current
+            from authorization.grants import upsert_permission
+            from authorization.snapshot import read_snapshot_version
+
+            user_version = get_user_version(OTHER_USER_EMAIL)
+            self.assertFalse(upsert_permission(OTHER_USER_EMAIL, FAKE_ITEM_1, "VIEW")[1])
+            self.assertEqual(read_snapshot_version(path), get_change_version())
+            self.assertGreater(get_user_version(OTHER_USER_EMAIL), user_version)
+
+    def test_refresh_permission_snapshot_watch(self):
+        """
+        Test that the refresher refuses a cache it cannot share with the workers, and waits longer between
+        rebuilds the longer they take.
+        """
+
+        from authorization.management.commands.refresh_permission_snapshot import Command
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "permissions.snapshot")
+
+        with self.assertRaises(CommandError):
+            call_command("refresh_permission_snapshot", watch=True, path=path, stdout=io.StringIO())
+
+        def count_refreshes(backoff):
+            # Every round finds the snapshot out of date, and each rebuild takes 10 seconds
+            with patch.object(Command, "refresh", return_value=10) as refresh, \
+                    patch("authorization.management.commands.refresh_permission_snapshot.time.sleep", side_effect=[None] * 3 + [KeyboardInterrupt]):
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command("refresh_permission_snapshot", watch=True, path=path, backoff=backoff, stdout=io.StringIO())
+            return refresh.call_count
+
+        caches = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}}
+        with self.settings(CACHES=caches):
+            self.assertEqual(count_refreshes(0), 4)
+            self.assertEqual(count_refreshes(5), 1)
+
+    def test_benchmark_permissions_command(self):
+        """
+        Test that the benchmark command reports every scenario as JSON and removes its records afterwards,
+        and that it refuses to run with DEBUG off unless told it is not in production.
+        """
+
+        existing = set(UserPermission.objects.values_list("id", flat=True))
+
+        output = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        output.close()
+        self.addCleanup(os.unlink, output.name)
+
+        with override_settings(DEBUG=False), self.assertRaises(CommandError):
+            call_command("benchmark_permissions", users=30, items=5, grants=60, output=output.name, stdout=io.StringIO())
+        self.assertEqual(set(UserPermission.objects.values_list("id", flat=True)), existing)
+
+        call_command("benchmark_permissions", users=30, items=5, grants=60, iterations=3, snapshot=True, workers=2, output=output.name,
+                     i_know_this_is_not_production=True, stdout=io.StringIO())
+
+        with open(output.name) as f:
+            report = json.load(f)
+
+        self.assertEqual(report["dataset"]["items"], 5)
+        self.assertEqual(report["dataset"]["total_records"], report["dataset"]["records"] + len(existing))
+        self.assertEqual(report["results"]["check (MANAGE, other user)"]["statuses"], {"200": 3})
+        self.assertEqual(report["results"]["create + remove_item_view_permission_record"]["statuses"], {"200/200": 3})
+
+        for result in report["results"].values():
+            self.assertEqual(result["iterations"], 3)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+        self.assertGreater(report["snapshot"]["cache_users"], 0)
+        self.assertGreaterEqual(report["snapshot"]["snapshot_keys"], report["dataset"]["records"])
+
+        self.assertEqual(set(UserPermission.objects.values_list("id", flat=True)), existing)
+
     @patch('authorization.views.get_email_from_jwt')
     def test_create_view_permission_success(self, get_email_from_jwt):
         """
@@ -209,43 +834,54 @@ class UserPermissionTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
     @patch('authorization.views.get_email_from_jwt')
-    def test_remove_view_permission_success(self, get_email_from_jwt):
+    def test_bulk_create_view_permissions(self, get_email_from_jwt):
         """
-        Tests the removal of a VIEW permission. This requires that the request come
-        from someone with MANAGE permissions on the given item.
+        Test creating VIEW permissions for several users at once, which requires MANAGE permissions
+        on every item.
         """
 
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        grantees = [USER_EMAIL, OTHER_USER_EMAIL] + ["grantee%s@example.org" % i for i in range(20)]
+        self.assertFalse(get_permission_set(OTHER_USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+        f = furl("/user_permission/bulk_create_item_view_permission_records/")
+
         # Mock the user sending the request
         get_email_from_jwt.return_value = MANAGER_EMAIL
 
-        # Create the permission first
-        view_permission = UserPermission.objects.get_or_create(
-            user_email=USER_EMAIL,
-            item=FAKE_ITEM_1,
-            permission="VIEW"
-        )
+        response = self.client.post(f.url, {"grantee_emails": grantees, "item": FAKE_ITEM_1}, format="json")
 
-        f = furl("/user_permission/remove_item_view_permission_record/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["created"], 21)
+        self.assertEqual(response.data["existing"], 1)
+        self.assertEqual(UserPermission.objects.filter(item=FAKE_ITEM_1, permission="VIEW").count(), 22)
 
-        # Data for the POST payload
-        data = {
-            "grantee_email": USER_EMAIL,
-            "item": FAKE_ITEM_1
-        }
+        # The new grantees' cached permissions were invalidated
+        self.assertTrue(get_permission_set(OTHER_USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
 
-        response = self.client.post(f.url, data)
+        # A repeated item is only granted and counted once
+        response = self.client.post(f.url, {"grantee_emails": ["grantee@example.org"], "items": [FAKE_ITEM_1, FAKE_ITEM_1]}, format="json")
+        self.assertEqual((response.data["created"], response.data["existing"]), (1, 0))
 
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Grantees must be emails
+        response = self.client.post(f.url, {"grantee_emails": [USER_EMAIL, None], "item": FAKE_ITEM_1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The manager does not manage the second item
+        response = self.client.post(f.url, {"grantee_emails": grantees, "items": [FAKE_ITEM_1, FAKE_ITEM_2]}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(UserPermission.objects.filter(item=FAKE_ITEM_2).count(), 0)
 
     @patch('authorization.views.get_email_from_jwt')
-    def test_remove_view_permission_denied(self, get_email_from_jwt):
+    def test_remove_view_permission_success(self, get_email_from_jwt):
         """
-        Tests the removal of a VIEW permission from someone who does not have
-        MANAGE permissions on the given item.
+        Tests the removal of a VIEW permission. This requires that the request come
+        from someone with MANAGE permissions on the given item.
         """
 
         # Mock the user sending the request
-        get_email_from_jwt.return_value = USER_EMAIL
+        get_email_from_jwt.return_value = MANAGER_EMAIL
 
         # Create the permission first
         view_permission = UserPermission.objects.get_or_create(
@@ -264,17 +900,134 @@ class UserPermissionTest(APITestCase):
 
         response = self.client.post(f.url, data)
 
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
 
     @patch('authorization.views.get_email_from_jwt')
-    def test_create_registration_permission_record(self, get_email_from_jwt):
+    def test_bulk_remove_view_permissions(self, get_email_from_jwt):
         """
-        Tests the creation of a SciReg VIEW permission. The person making the request
-        is giving the grantee permission to view their SciReg profile.
+        Test removing the VIEW permissions of several users, and then of everyone, from an item.
         """
 
-        # Mock the user sending the request
-        get_email_from_jwt.return_value = USER_EMAIL
+        UserPermission.objects.bulk_create([
+            UserPermission(user_email=email, item=FAKE_ITEM_1, permission="VIEW")
+            for email in [USER_EMAIL, OTHER_USER_EMAIL] + ["grantee%s@example.org" % i for i in range(20)]
+        ])
+        self.assertTrue(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+        f = furl("/user_permission/bulk_remove_item_view_permission_records/")
+
+        # Someone without MANAGE permissions cannot remove anything
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.post(f.url, {"grantee_emails": [OTHER_USER_EMAIL], "item": FAKE_ITEM_1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Remove a few users
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        response = self.client.post(f.url, {"grantee_emails": [USER_EMAIL, MANAGER_EMAIL], "item": FAKE_ITEM_1}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["removed"], 1)
+        self.assertFalse(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+        # Grantees must be emails
+        response = self.client.post(f.url, {"grantee_emails": [OTHER_USER_EMAIL, 42], "item": FAKE_ITEM_1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Then everyone else, which leaves the manager's MANAGE permission in place
+        self.assertTrue(get_permission_set(OTHER_USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(f.url, {"all": True, "item": FAKE_ITEM_1}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["removed"], 21)
+
+        # The records are removed with a single statement, not read again and deleted one by one
+        deletes = [query["sql"] for query in context.captured_queries if query["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(list(UserPermission.objects.filter(item=FAKE_ITEM_1).values_list("permission", flat=True)), ["MANAGE"])
+        self.assertFalse(get_permission_set(OTHER_USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_sync_view_permissions(self, get_email_from_jwt):
+        """
+        Test replacing the users with VIEW permissions on an item with a new list of users.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        UserPermission.objects.create(user_email=OTHER_USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+        f = furl("/user_permission/sync_item_view_permission_records/")
+        data = {"grantee_emails": [OTHER_USER_EMAIL, "grantee@example.org"], "item": FAKE_ITEM_1}
+
+        # Someone without MANAGE permissions cannot change the list
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.post(f.url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+        self.assertTrue(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+        response = self.client.post(f.url, data, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"added": ["grantee@example.org"], "removed": [USER_EMAIL]})
+        self.assertFalse(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+        self.assertEqual(
+            set(UserPermission.objects.filter(item=FAKE_ITEM_1, permission="VIEW").values_list("user_email", flat=True)),
+            {OTHER_USER_EMAIL, "grantee@example.org"}
+        )
+
+        # Syncing the same list again changes nothing
+        response = self.client.post(f.url, data, format="json")
+        self.assertEqual(response.data, {"added": [], "removed": []})
+
+        # A listed user with a permission implying VIEW already has it, and is not given a VIEW record
+        data["grantee_emails"].append(MANAGER_EMAIL)
+        response = self.client.post(f.url, data, format="json")
+        self.assertEqual(response.data, {"added": [], "removed": []})
+        self.assertFalse(UserPermission.objects.filter(user_email=MANAGER_EMAIL, item=FAKE_ITEM_1, permission="VIEW").exists())
+
+        # Grantees must be emails
+        response = self.client.post(f.url, {"grantee_emails": [OTHER_USER_EMAIL, None], "item": FAKE_ITEM_1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_remove_view_permission_denied(self, get_email_from_jwt):
+        """
+        Tests the removal of a VIEW permission from someone who does not have
+        MANAGE permissions on the given item.
+        """
+
+        # Mock the user sending the request
+        get_email_from_jwt.return_value = USER_EMAIL
+
+        # Create the permission first
+        view_permission = UserPermission.objects.get_or_create(
+            user_email=USER_EMAIL,
+            item=FAKE_ITEM_1,
+            permission="VIEW"
+        )
+
+        f = furl("/user_permission/remove_item_view_permission_record/")
+
+        # Data for the POST payload
+        data = {
+            "grantee_email": USER_EMAIL,
+            "item": FAKE_ITEM_1
+        }
+
+        response = self.client.post(f.url, data)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_create_registration_permission_record(self, get_email_from_jwt):
+        """
+        Tests the creation of a SciReg VIEW permission. The person making the request
+        is giving the grantee permission to view their SciReg profile.
+        """
+
+        # Mock the user sending the request
+        get_email_from_jwt.return_value = USER_EMAIL
 
         f = furl("/user_permission/create_registration_permission_record/")
 
@@ -287,3 +1040,761 @@ class UserPermissionTest(APITestCase):
         response = self.client.post(f.url, data)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Sending the same request again should not create a second record.
+        response = self.client.post(f.url, data)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(UserPermission.objects.filter(user_email=MANAGER_EMAIL, permission="VIEW").count(), 1)
+
+    def test_upsert_permission(self):
+        """
+        Test that granting an existing permission refreshes its date_updated instead of adding a record, and
+        that the change is seen through the permission cache.
+        """
+
+        from authorization.grants import upsert_permission
+
+        self.assertFalse(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+        record, created = upsert_permission(USER_EMAIL, FAKE_ITEM_1, "VIEW")
+        self.assertTrue(created)
+        self.assertEqual(UserPermission.objects.get(id=record.id).user_email, USER_EMAIL)
+        self.assertTrue(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_1, "VIEW"))
+
+        UserPermission.objects.filter(id=record.id).update(date_updated=datetime(2000, 1, 1, tzinfo=timezone.utc))
+
+        again, created = upsert_permission(USER_EMAIL, FAKE_ITEM_1, "VIEW")
+        self.assertFalse(created)
+        self.assertEqual(again.id, record.id)
+        self.assertEqual(UserPermission.objects.filter(user_email=USER_EMAIL, item=FAKE_ITEM_1).count(), 1)
+        self.assertGreater(UserPermission.objects.get(id=record.id).date_updated.year, 2000)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_normalized_email(self, get_email_from_jwt):
+        """
+        Test that records are looked up by their normalized email whatever the case of the email they
+        were granted to, and that the backfill command sets the normalized email of older records.
+        """
+
+        from authorization.grants import upsert_permission
+
+        created = UserPermission.objects.create(user_email=" User@Example.com", item=FAKE_ITEM_1, permission="VIEW")
+        upserted, _ = upsert_permission("USER@example.com", FAKE_ITEM_2, "VIEW")
+        UserPermission.objects.bulk_create([UserPermission(user_email="User@EXAMPLE.com", item=FAKE_ITEM_3, permission="VIEW")])
+
+        self.assertEqual(set(UserPermission.objects.filter(normalized_email=USER_EMAIL).values_list("item", flat=True)), {FAKE_ITEM_1, FAKE_ITEM_2, FAKE_ITEM_3})
+        self.assertTrue(get_permission_set(USER_EMAIL.upper()).has_permission(FAKE_ITEM_2, "VIEW"))
+
+        get_email_from_jwt.return_value = USER_EMAIL
+        self.assertEqual(self.client.get("/user_permission/").data["count"], 3)
+
+        # A grant to another case of the email refreshes the existing record
+        again, created_again = upsert_permission("user@EXAMPLE.COM ", FAKE_ITEM_2, "VIEW")
+        self.assertFalse(created_again)
+        self.assertEqual(again.id, upserted.id)
+        self.assertEqual(UserPermission.objects.filter(normalized_email=USER_EMAIL, item=FAKE_ITEM_2).count(), 1)
+
+        # The backfills normalize as normalize_email does, including tabs, newlines and non-ASCII capitals
+        import importlib
+        from django.apps import apps
+
+        spaced = UserPermission.objects.create(user_email="\tUser@Example.com\n", item=FAKE_ITEM_1, permission="EDIT")
+        accented = UserPermission.objects.create(user_email="ÉLODIE@Example.com", item=FAKE_ITEM_1, permission="VIEW")
+        backfilled = {created.id: USER_EMAIL, upserted.id: USER_EMAIL, spaced.id: USER_EMAIL, accented.id: "élodie@example.com"}
+
+        UserPermission.objects.filter(id__in=backfilled).update(normalized_email=None)
+        call_command("backfill_normalized_emails", batch_size=1, sleep=0, stdout=io.StringIO())
+        self.assertFalse(UserPermission.objects.filter(normalized_email__isnull=True).exists())
+        self.assertEqual(dict(UserPermission.objects.filter(id__in=backfilled).values_list("id", "normalized_email")), backfilled)
+
+        UserPermission.objects.filter(id__in=backfilled).update(normalized_email=None)
+        importlib.import_module("authorization.migrations.0024_backfill_normalized_email").backfill_normalized_email(apps, None)
+        self.assertEqual(dict(UserPermission.objects.filter(id__in=backfilled).values_list("id", "normalized_email")), backfilled)
+
+        # --all corrects records backfilled before with the database's TRIM and LOWER
+        UserPermission.objects.filter(id=spaced.id).update(normalized_email="\tuser@example.com\n")
+        call_command("backfill_normalized_emails", all=True, sleep=0, stdout=io.StringIO())
+        self.assertEqual(UserPermission.objects.get(id=spaced.id).normalized_email, USER_EMAIL)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_item_and_permission_type_references(self, get_email_from_jwt):
+        """
+        Test that every way of writing a record also points it at its Item and PermissionType, and that the
+        API still returns the item and permission by name.
+        """
+
+        from authorization.grants import grant_permissions
+        from authorization.grants import upsert_permission
+        from authorization.models import Item
+        from authorization.models import PermissionType
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+        upsert_permission(USER_EMAIL, FAKE_ITEM_2, "VIEW")
+        grant_permissions([FAKE_ITEM_3], [USER_EMAIL, OTHER_USER_EMAIL], "VIEW")
+        UserPermission.objects.bulk_create([UserPermission(user_email=OTHER_USER_EMAIL, item=FAKE_ITEM_1, permission="MANAGE")])
+
+        for record in UserPermission.objects.select_related("item_ref", "permission_ref"):
+            self.assertEqual((record.item_ref.name, record.permission_ref.name), (record.item, record.permission))
+
+        self.assertEqual(set(Item.objects.values_list("name", flat=True)), {FAKE_ITEM_1, FAKE_ITEM_2, FAKE_ITEM_3})
+        self.assertEqual(set(PermissionType.objects.values_list("name", flat=True)), {"VIEW", "MANAGE"})
+        self.assertEqual(Item.objects.get(name=FAKE_ITEM_3).permissions.count(), 2)
+
+        get_email_from_jwt.return_value = USER_EMAIL
+        response = self.client.get("/user_permission/", {"item": FAKE_ITEM_2})
+        self.assertEqual(
+            [(record["item"], record["permission"]) for record in response.data["results"]],
+            [(FAKE_ITEM_2, "VIEW")]
+        )
+
+        # The item lookups of the API compare the references, not the names
+        from authorization.views import get_authorized_user_permissions
+        with CaptureQueriesContext(connection) as context:
+            list(get_authorized_user_permissions(OTHER_USER_EMAIL, item=FAKE_ITEM_1))
+        self.assertIn('"item_ref_id" IN (SELECT', context.captured_queries[-1]["sql"])
+        self.assertNotIn('"authorization_userpermission"."item" =', context.captured_queries[-1]["sql"])
+
+        # Renaming through update() moves the references along, so the lookups see it
+        UserPermission.objects.filter(user_email=USER_EMAIL, item=FAKE_ITEM_2).update(permission="MANAGE")
+        self.assertEqual(UserPermission.objects.get(user_email=USER_EMAIL, item=FAKE_ITEM_2).permission_ref.name, "MANAGE")
+        invalidate_permissions(emails=[USER_EMAIL])
+        self.assertTrue(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_2, "MANAGE"))
+
+        # The bulk commands and the export match the references too
+        from authorization.grants import revoke_permissions
+        from authorization.grants import sync_permissions
+        for command in (lambda: revoke_permissions([FAKE_ITEM_3], "VIEW", [OTHER_USER_EMAIL]), lambda: sync_permissions(FAKE_ITEM_3, [USER_EMAIL], "VIEW")):
+            with CaptureQueriesContext(connection) as context:
+                command()
+            for query in context.captured_queries:
+                self.assertNotIn('"authorization_userpermission"."item" =', query["sql"])
+
+    def test_backfill_permission_refs_command(self):
+        """
+        Test that the backfill command points records written without references, as by older code running during
+        a deploy before migration 0029 made them required, at their Item and PermissionType.
+        """
+
+        from django.db import models
+        from authorization.models import Item
+
+        # The item reference as it is now, and as it was before migration 0029
+        fields = []
+        for null in (False, True):
+            field = models.ForeignKey(Item, null=null, on_delete=models.PROTECT, related_name="+")
+            field.set_attributes_from_name("item_ref")
+            field.model = UserPermission
+            fields.append(field)
+
+        record = UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_2, permission="VIEW")
+        with connection.schema_editor() as editor:
+            editor.alter_field(UserPermission, fields[0], fields[1])
+        UserPermission.objects.filter(id=record.id).update(item_ref_id=None)
+        self.assertFalse(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_2, "VIEW"))
+
+        output = io.StringIO()
+        call_command("backfill_permission_refs", dry_run=True, stdout=output)
+        self.assertIn("Found 1 records to backfill.", output.getvalue())
+
+        call_command("backfill_permission_refs", batch_size=1, sleep=0, stdout=io.StringIO())
+        record = UserPermission.objects.select_related("item_ref", "permission_ref").get(id=record.id)
+        self.assertEqual((record.item_ref.name, record.permission_ref.name), (FAKE_ITEM_2, "VIEW"))
+
+        # The cached permissions of the user are invalidated, so the record is seen again
+        self.assertTrue(get_permission_set(USER_EMAIL).has_permission(FAKE_ITEM_2, "VIEW"))
+
+        with connection.schema_editor() as editor:
+            editor.alter_field(UserPermission, fields[1], fields[0])
+
+    def test_upsert_sql_for_mysql(self):
+        """
+        Test the statement used on MySQL, where a grant that exists is refreshed and its ID reported.
+        """
+
+        from types import SimpleNamespace
+
+        from authorization.grants import _upsert_sql
+
+        mysql = SimpleNamespace(vendor="mysql", ops=SimpleNamespace(quote_name=lambda name: "`%s`" % name))
+
+        self.assertEqual(
+            _upsert_sql(mysql, 2, "update"),
+            "INSERT INTO `authorization_userpermission` "
+            "(`user_email`, `normalized_email`, `item`, `permission`, `item_ref_id`, `permission_ref_id`, `date_updated`) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s), (%s, %s, %s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE `id` = LAST_INSERT_ID(`id`), `date_updated` = VALUES(`date_updated`)"
+        )
+
+
+class UserPermissionIndexTest(TestCase):
+    """
+    This class checks that the lookups made on every UserPermission request are answered from one
+    of the table's indexes rather than by scanning the whole table.
+    """
+
+    def setUp(self):
+        """
+        Fill the table with enough grants that the query planner prefers an index.
+        """
+
+        UserPermission.objects.bulk_create([
+            UserPermission(user_email="user%s@example.com" % (i % 50), item="Sci.Item%s" % (i // 50), permission=permission)
+            for i in range(500)
+            for permission in ("VIEW", "MANAGE")
+            if permission == "VIEW" or i % 10 == 0
+        ])
+
+    def get_index_names(self):
+        """
+        Returns the names of the secondary indexes on the UserPermission table.
+        """
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, UserPermission._meta.db_table)
+
+        return [name for name, constraint in constraints.items() if not constraint['primary_key'] and not constraint['foreign_key']]
+
+    def get_query_plan(self, queryset):
+        """
+        Returns the database's query plan for the given QuerySet as a single string.
+        """
+
+        sql, params = queryset.query.sql_with_params()
+        explain = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+
+        with connection.cursor() as cursor:
+            cursor.execute(explain + sql, params)
+            return " ".join(str(column) for row in cursor.fetchall() for column in row)
+
+    def assertUsesIndex(self, queryset):
+        plan = self.get_query_plan(queryset)
+        self.assertTrue(any(name in plan for name in self.get_index_names()), plan)
+
+    def test_managed_items_query_uses_index(self):
+        """
+        Test the lookup of the items a user manages.
+        """
+
+        self.assertUsesIndex(UserPermission.objects.filter_names(permissions=["MANAGE"]).filter(normalized_email="user0@example.com").values('item'))
+
+    def test_manage_check_query_uses_index(self):
+        """
+        Test the lookup made before a user is allowed to create or remove a grant on an item.
+        """
+
+        self.assertUsesIndex(UserPermission.objects.filter_names(items=["Sci.Item0"], permissions=["MANAGE"]).filter(normalized_email="user0@example.com"))
+
+    def test_item_grants_query_uses_index(self):
+        """
+        Test the lookup of all the grants of a permission on an item.
+        """
+
+        self.assertUsesIndex(UserPermission.objects.filter_names(items=["Sci.Item0"], permissions=["VIEW"]))
+
+    def test_duplicate_permission_is_rejected(self):
+        """
+        Test that a user cannot hold the same permission on an item twice.
+        """
+
+        UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+        with self.assertRaises(IntegrityError):
+            UserPermission.objects.create(user_email=USER_EMAIL, item=FAKE_ITEM_1, permission="VIEW")
+
+
+class PermissionCacheTest(TestCase):
+    """
+    This class tests the in-process cache of each user's permissions.
+    """
+
+    def setUp(self):
+        permission_cache.clear()
+        cache.clear()
+
+    def test_cache_hit_and_invalidation(self):
+        """
+        Test that a user's permissions are loaded once and reloaded after they change.
+        """
+
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_1, permission="MANAGE")
+        hits, misses = permission_cache.hits, permission_cache.misses
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_permission_set(MANAGER_EMAIL.upper()).managed_items, {FAKE_ITEM_1})
+
+        self.assertEqual(permission_cache.hits - hits, 1)
+        self.assertEqual(permission_cache.misses - misses, 1)
+
+        # Saving a permission drops the user's cached entry
+        permission = UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_2, permission="MANAGE")
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1, FAKE_ITEM_2})
+
+        # So does deleting one
+        permission.delete()
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+        self.assertIn((FAKE_ITEM_1, "MANAGE"), get_permission_set(MANAGER_EMAIL).owned)
+
+    def test_shared_cache_versions(self):
+        """
+        Test that bumping a user's version in the shared cache invalidates the permissions that any
+        worker holds for them, and that a worker without a local entry reads from the shared cache.
+        """
+
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_1, permission="MANAGE")
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+
+        # Another worker starting with an empty local cache does not query the database
+        permission_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+
+        # A write made by another worker does not touch this worker's local cache...
+        UserPermission.objects.bulk_create([UserPermission(user_email=MANAGER_EMAIL, item=FAKE_ITEM_2, permission="MANAGE")])
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+
+        # ...but the version it bumps in the shared cache does.
+        version = get_user_version(MANAGER_EMAIL)
+        cache.incr('sciauthz:version:user:' + hashlib.sha1(MANAGER_EMAIL.encode('utf-8')).hexdigest())
+        self.assertEqual(get_user_version(MANAGER_EMAIL), version + 1)
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1, FAKE_ITEM_2})
+
+        # Which is what invalidating the user's permissions does
+        UserPermission.objects.filter(item=FAKE_ITEM_2).update(permission="VIEW")
+        invalidate_permissions(emails=[MANAGER_EMAIL])
+        self.assertEqual(get_permission_set(MANAGER_EMAIL).managed_items, {FAKE_ITEM_1})
+
+    def test_shared_cache_is_required(self):
+        """
+        Test that a cache each worker keeps to itself is refused outside of DEBUG.
+        """
+
+        from authorization.checks import check_shared_cache
+
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        memcached = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache', 'LOCATION': 'memcached:11211'}}
+
+        with self.settings(DEBUG=False, CACHES=locmem):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['authorization.E001'])
+        with self.settings(DEBUG=True, CACHES=locmem):
+            self.assertEqual(check_shared_cache(None), [])
+        with self.settings(DEBUG=False, CACHES=memcached):
+            self.assertEqual(check_shared_cache(None), [])
+
+    @patch('authorization.cache.time')
+    def test_cache_eviction_and_expiry(self, mock_time):
+        """
+        Test that the least recently used entry is evicted and that entries expire after the TTL.
+        """
+
+        mock_time.monotonic.return_value = 0
+        cache = PermissionCache(max_size=2, ttl=60)
+
+        cache.set(USER_EMAIL, "user")
+        cache.set(OTHER_USER_EMAIL, "other")
+        cache.get(USER_EMAIL)
+        cache.set(MANAGER_EMAIL, "manager")
+
+        self.assertIsNone(cache.get(OTHER_USER_EMAIL))
+        self.assertEqual(cache.get(USER_EMAIL), "user")
+        self.assertEqual(cache.get(MANAGER_EMAIL), "manager")
+
+        mock_time.monotonic.return_value = 61
+        self.assertIsNone(cache.get(USER_EMAIL))
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 2, 'size': 1})
+
+
+class CachedJSONWebTokenAuthenticationTest(TestCase):
+    """
+    This class tests the authentication of requests with JWTs, using a signing key generated for the
+    test and a local JWKS file in place of Auth0.
+    """
+
+    def setUp(self):
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        from authorization.authentication import signing_keys
+        from authorization.authentication import verified_tokens
+
+        signing_keys.clear()
+        verified_tokens.clear()
+
+        # A self-signed certificate for a new key, published in a JWKS file
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "sciauthz-test")])
+        certificate = x509.CertificateBuilder()\
+            .subject_name(name)\
+            .issuer_name(name)\
+            .public_key(self.private_key.public_key())\
+            .serial_number(1)\
+            .not_valid_before(datetime(2000, 1, 1))\
+            .not_valid_after(datetime(2100, 1, 1))\
+            .sign(self.private_key, hashes.SHA256(), default_backend())
+
+        jwks = {"keys": [{"kid": "test-key", "x5c": [base64.b64encode(certificate.public_bytes(serialization.Encoding.DER)).decode("ascii")]}]}
+
+        self.jwks_file = tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False)
+        json.dump(jwks, self.jwks_file)
+        self.jwks_file.close()
+
+        self.private_pem = self.private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+
+        self.settings_override = self.settings(AUTH0_JWKS_FILE=self.jwks_file.name)
+        self.settings_override.enable()
+
+        self.auth0_override = self.auth0_settings(CLIENT_ID_LIST=["test-client"], ALGORITHM="RS256")
+        self.auth0_override.start()
+
+    def tearDown(self):
+        self.auth0_override.stop()
+        self.settings_override.disable()
+        os.unlink(self.jwks_file.name)
+
+    def auth0_settings(self, **auth0):
+        """
+        Returns a patch of pyauth0jwtrest's AUTH0 settings as read by the authentication, which reads them once.
+        Settings given as None are left out, so that pyauth0jwtrest's defaults apply.
+        """
+
+        from pyauth0jwtrest.settings import DEFAULTS
+        from pyauth0jwtrest.settings import IMPORT_STRINGS
+        from rest_framework.settings import APISettings
+
+        auth0 = dict((name, value) for name, value in dict(settings.AUTH0, **auth0).items() if value is not None)
+        return patch("authorization.authentication.auth0_api_settings", APISettings(auth0, DEFAULTS, IMPORT_STRINGS))
+
+    def make_request(self, audience="test-client", expires_in=300):
+        token = jwt.encode(
+            {"email": USER_EMAIL, "aud": audience, "exp": int(time.time()) + expires_in},
+            self.private_pem,
+            algorithm="RS256",
+            headers={"kid": "test-key"}
+        ).decode("ascii")
+
+        return Request(APIRequestFactory().get("/user_permission/", HTTP_AUTHORIZATION="JWT " + token))
+
+    def test_verified_claims_are_cached(self):
+        """
+        Test that a token is verified once and its claims are then reused, including for the email.
+        """
+
+        from authorization.authentication import CachedAuth0JSONWebTokenAuthentication
+        from authorization.authentication import verified_tokens
+        from authorization.views import get_email_from_jwt
+
+        authentication = CachedAuth0JSONWebTokenAuthentication()
+        request = self.make_request()
+
+        user, claims = authentication.authenticate(request)
+        self.assertEqual(user.email, USER_EMAIL)
+        self.assertEqual(claims["email"], USER_EMAIL)
+
+        with patch("authorization.authentication.verify_token") as verify_token:
+            user, claims = authentication.authenticate(request)
+            self.assertFalse(verify_token.called)
+
+        self.assertEqual(verified_tokens.stats()["hits"], 1)
+
+        request.user, request.auth = user, claims
+        with patch("authorization.views.get_email_from_request") as get_email_from_request:
+            self.assertEqual(get_email_from_jwt(request), USER_EMAIL)
+            self.assertFalse(get_email_from_request.called)
+
+    def test_invalid_tokens_are_rejected(self):
+        """
+        Test that tokens for another audience or that have expired are rejected.
+        """
+
+        from authorization.authentication import CachedAuth0JSONWebTokenAuthentication
+
+        authentication = CachedAuth0JSONWebTokenAuthentication()
+
+        with self.assertRaises(AuthenticationFailed):
+            authentication.authenticate(self.make_request(audience="other-client"))
+
+        with self.assertRaises(AuthenticationFailed):
+            authentication.authenticate(self.make_request(expires_in=-3600))
+
+    def test_hs256_client_secret(self):
+        """
+        Test that HS256 tokens are verified with the client secret, base64 decoded unless the settings say it is not encoded.
+        """
+
+        from authorization.authentication import verify_token
+
+        secret = "not-base64-encoded-secret"
+        token = jwt.encode({"email": USER_EMAIL, "aud": "test-client", "exp": int(time.time()) + 300}, secret, algorithm="HS256")
+
+        with self.auth0_settings(CLIENT_ID_LIST=["test-client"], ALGORITHM="HS256", CLIENT_SECRET=secret, CLIENT_SECRET_BASE64_ENCODED=False):
+            self.assertEqual(verify_token(token)["email"], USER_EMAIL)
+
+        # The secret is base64 encoded by default
+        encoded = base64.urlsafe_b64encode(secret.encode("ascii")).decode("ascii")
+        with self.auth0_settings(CLIENT_ID_LIST=["test-client"], ALGORITHM="HS256", CLIENT_SECRET=encoded):
+            self.assertEqual(verify_token(token)["email"], USER_EMAIL)
+
+        # Without an ALGORITHM setting, tokens are expected to be signed with RS256 as in pyauth0jwtrest
+        with self.auth0_settings(CLIENT_ID_LIST=["test-client"], ALGORITHM=None, CLIENT_SECRET=secret, CLIENT_SECRET_BASE64_ENCODED=False):
+            with self.assertRaises(AuthenticationFailed):
+                verify_token(token)
+
+    def test_concurrent_requests_wait_for_signing_keys(self):
+        """
+        Test that requests arriving while the signing keys are first loaded wait for them instead of failing.
+        """
+
+        import threading
+
+        from authorization.authentication import CachedAuth0JSONWebTokenAuthentication
+        from authorization.authentication import signing_keys
+
+        authentication = CachedAuth0JSONWebTokenAuthentication()
+        requests = [self.make_request(expires_in=300 + i) for i in range(8)]
+        failures = []
+
+        refresh = signing_keys.refresh
+
+        def slow_refresh():
+            time.sleep(0.2)
+            refresh()
+
+        def authenticate(request):
+            try:
+                authentication.authenticate(request)
+            except AuthenticationFailed as e:
+                failures.append(e)
+
+        with patch.object(signing_keys, "refresh", side_effect=slow_refresh) as patched_refresh:
+            threads = [threading.Thread(target=authenticate, args=(request,)) for request in requests]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(patched_refresh.call_count, 1)
+
+
+class ConnectionHealthCheckMiddlewareTest(TestCase):
+    """
+    This class tests that idle persistent database connections are checked before they are reused.
+    """
+
+    def test_unusable_idle_connection_is_closed(self):
+        """
+        Test that a connection left idle past the interval is closed if it no longer responds, and kept otherwise.
+        """
+
+        from SciAuthZ.middleware import ConnectionHealthCheckMiddleware
+
+        middleware = ConnectionHealthCheckMiddleware(lambda request: "response")
+        connection.ensure_connection()
+
+        with patch.object(connection, "is_usable", return_value=True) as is_usable, \
+                patch.object(connection, "close") as close:
+
+            self.assertEqual(middleware(None), "response")
+            self.assertFalse(is_usable.called)
+
+            # Used recently, so it is not pinged
+            middleware(None)
+            self.assertFalse(is_usable.called)
+
+            connection.last_request_at = time.monotonic() - settings.DB_HEALTH_CHECK_INTERVAL - 1
+            middleware(None)
+            self.assertTrue(is_usable.called)
+            self.assertFalse(close.called)
+
+            is_usable.return_value = False
+            connection.last_request_at = time.monotonic() - settings.DB_HEALTH_CHECK_INTERVAL - 1
+            middleware(None)
+            self.assertTrue(close.called)
+
+
+class BackgroundHandlerTest(TestCase):
+    """
+    This class tests that log records are written by a background thread, and that a forked process starts its own.
+    """
+
+    def test_records_are_written_in_background(self):
+        """
+        Test that records reach the target handler formatted, from a listener started in each process.
+        """
+
+        import logging
+
+        from SciAuthZ.log_handlers import BackgroundHandler
+
+        stream = io.StringIO()
+        handler = BackgroundHandler([logging.StreamHandler(stream)])
+        logger = logging.getLogger("background-test")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        logger.warning("Checked %s on %s.", USER_EMAIL, FAKE_ITEM_1)
+        first_listener = handler.listener
+
+        # A new process id, as after a fork, starts a new listener
+        with patch("SciAuthZ.log_handlers.os.getpid", return_value=os.getpid() + 1):
+            logger.warning("Checked %s on %s.", OTHER_USER_EMAIL, FAKE_ITEM_1)
+            self.assertIsNot(handler.listener, first_listener)
+            handler.close()
+
+        first_listener.stop()
+
+        self.assertCountEqual(stream.getvalue().splitlines(), [
+            "Checked %s on %s." % (USER_EMAIL, FAKE_ITEM_1),
+            "Checked %s on %s." % (OTHER_USER_EMAIL, FAKE_ITEM_1),
+        ])
+
+    def test_one_listener_per_process(self):
+        """
+        Test that threads logging together in a new process start a single listener.
+        """
+
+        import logging
+        import threading
+
+        from SciAuthZ.log_handlers import BackgroundHandler
+
+        handler = BackgroundHandler([logging.NullHandler()])
+        record = logging.makeLogRecord({"msg": "Checked."})
+        with patch("SciAuthZ.log_handlers.QueueListener.start") as start:
+            threads = [threading.Thread(target=handler.enqueue, args=(record,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(start.call_count, 1)
+
+    def test_configure_logging(self):
+        """
+        Test that the root logger's configured handlers are moved behind a single background handler.
+        """
+
+        import logging
+
+        from SciAuthZ.log_handlers import BackgroundHandler, configure_logging
+
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, "handlers", list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+
+        configure_logging({
+            "version": 1,
+            "disable_existing_loggers": False,
+            "handlers": {
+                "first": {"class": "logging.NullHandler"},
+                "second": {"class": "logging.NullHandler"},
+            },
+            "root": {"handlers": ["first", "second"], "level": "INFO"},
+        })
+
+        self.assertEqual(len(root.handlers), 1)
+        self.assertIsInstance(root.handlers[0], BackgroundHandler)
+        self.assertEqual([handler.get_name() for handler in root.handlers[0].handlers], ["first", "second"])
+        root.handlers[0].close()
+
+
+class QueryInstrumentationMiddlewareTest(APITestCase):
+    """
+    This class tests that requests report the number and duration of their database queries.
+    """
+
+    def setUp(self):
+        permission_cache.clear()
+        cache.clear()
+
+        manager_user = User.objects.create_user(MANAGER_EMAIL, email=MANAGER_EMAIL, password=MANAGER_PASSWORD)
+        self.client.force_authenticate(user=manager_user)
+
+        UserPermission.objects.create(user_email=MANAGER_EMAIL, item=FAKE_ITEM_1, permission="MANAGE")
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_server_timing_header(self, get_email_from_jwt):
+        """
+        Test that the Server-Timing header counts the queries, that queries are still captured for tests,
+        and that a request that is not slow is not logged.
+        """
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+
+        self.client.get("/user_permission/")
+        make_cursor = connection.make_cursor
+
+        with CaptureQueriesContext(connection) as context, patch("SciAuthZ.middleware.logger") as logger:
+            response = self.client.get("/user_permission/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('db;desc="%s queries"' % len(context.captured_queries), response["Server-Timing"])
+        self.assertIn("total;dur=", response["Server-Timing"])
+        self.assertFalse(logger.method_calls)
+
+        # The connection was instrumented once, not for each request, and queries are not logged for it
+        self.assertIs(connection.make_cursor, make_cursor)
+        self.assertFalse(connection.queries_logged)
+
+        # Queries made outside a request are not collected
+        UserPermission.objects.count()
+        from SciAuthZ.middleware import request_queries
+        self.assertIsNone(request_queries.queries)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_slow_requests_log_their_sql(self, get_email_from_jwt):
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+
+        with self.settings(SLOW_REQUEST_THRESHOLD_MS=0), self.assertLogs("SciAuthZ.middleware", level="WARNING") as logs:
+            self.client.get("/user_permission/", {"item": FAKE_ITEM_1})
+
+        self.assertIn("Slow request GET /user_permission/", logs.output[0])
+        self.assertIn("authorization_userpermission", logs.output[0])
+        self.assertEqual(logs.records[0].path, "/user_permission/")
+        self.assertGreater(logs.records[0].db_queries, 0)
+
+    @patch('authorization.views.get_email_from_jwt')
+    def test_metrics_by_action(self, get_email_from_jwt):
+        """
+        Test that /metrics counts requests by viewset action and status, and counts permission cache lookups.
+        """
+
+        get_email_from_jwt.return_value = MANAGER_EMAIL
+
+        def sample(name, **labels):
+            from prometheus_client import REGISTRY
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        requests_before = sample("sciauthz_requests_total", view="UserPermissionViewSet", action="check", method="GET", status="200")
+        misses_before = sample("sciauthz_cache_lookups_total", cache="local", result="miss")
+        hits_before = sample("sciauthz_cache_lookups_total", cache="local", result="hit")
+
+        for i in range(2):
+            response = self.client.get("/user_permission/check/", {"item": FAKE_ITEM_1, "permission": "MANAGE"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(sample("sciauthz_requests_total", view="UserPermissionViewSet", action="check", method="GET", status="200"), requests_before + 2)
+        self.assertEqual(sample("sciauthz_cache_lookups_total", cache="local", result="miss"), misses_before + 1)
+        self.assertEqual(sample("sciauthz_cache_lookups_total", cache="local", result="hit"), hits_before + 1)
+
+        # The metrics are only served to scrapers with the token
+        self.assertEqual(self.client.get("/metrics").status_code, status.HTTP_404_NOT_FOUND)
+
+        with self.settings(METRICS_TOKEN="metrics-token"):
+            self.assertEqual(self.client.get("/metrics").status_code, status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer other-token").status_code, status.HTTP_401_UNAUTHORIZED)
+
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer metrics-token")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'sciauthz_db_queries_per_request_count{action="check",view="UserPermissionViewSet"}', response.content)
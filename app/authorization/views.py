@@ -1,4 +1,7 @@
-from datetime import datetime
+import csv
+import hashlib
+import io
+import json
 
 from rest_framework import viewsets
 from rest_framework import permissions
@@ -10,16 +13,36 @@ from rest_framework.response import Response
 
 from authorization.serializers import UserPermissionSerializer
 from authorization.serializers import UserSerializer
+from authorization.models import Item
 from authorization.models import UserPermission
 from authorization.models import UserPermissionRequest
+from authorization.models import normalize_email
+from authorization.cache import get_permission_set
+from authorization.cache import get_item_versions
+from authorization.cache import get_user_versions
+from authorization.grants import grant_permissions
+from authorization.grants import revoke_permissions
+from authorization.grants import sync_permissions
+from authorization.grants import upsert_permission
+from authorization.items import get_item_prefix
+from authorization.items import is_prefix_item
+from authorization.pagination import UserPermissionCursorPagination
+from authorization.snapshot import get_check_permission_sets
 
 from pyauth0jwt.auth0authenticate import user_auth_and_jwt
 from pyauth0jwtrest.utils import get_email_from_request
 
+from django.conf import settings
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.contrib.auth.models import User
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_list_or_404
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+from django.utils.http import unquote_etag
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,35 +63,145 @@ def get_authorized_user_permissions(requesting_user, requested_user=None, record
     """
 
     if not requested_user and not record_id and not item:
-        return UserPermission.objects.filter(user_email=requesting_user)
+        return UserPermission.objects.filter(normalized_email=normalize_email(requesting_user))
 
     permission_records = UserPermission.objects.all()
 
     # Get all the possible records the user is requesting
     if requested_user:
-        permission_records = permission_records.filter(user_email=requested_user)
+        permission_records = permission_records.filter(normalized_email=normalize_email(requested_user))
     if record_id:
         permission_records = permission_records.filter(id=record_id)
     if item:
-        permission_records = permission_records.filter(item=item)
+        permission_records = permission_records.filter_names(items=[item])
 
-    # Get a list of all the items that the user manages
-    manage_permissions = UserPermission.objects.filter(user_email=requesting_user, permission="MANAGE")
-    managing_items = list(manage_permissions.values_list('item', flat=True).distinct())
+    # Get the items that the user manages
+    managing_items = get_permission_set(requesting_user).managed_items
 
-    # Check that the user either owns the record or has MANAGE permissions on such an item
-    for record in permission_records:
-        if record.user_email.lower() != requesting_user.lower() and record.item not in managing_items:
-            permission_records = permission_records.exclude(id=record.id)
+    # Check that the user either owns the record or has MANAGE permissions on such an item, or on a
+    # prefix grant that covers it. Items are compared by reference, their names looked up once in a subquery.
+    # Prefixes are matched on the unique Item name, from its start so its index can be used.
+    authorized = Q(normalized_email=normalize_email(requesting_user))
+    if managing_items:
+        authorized |= Q(item_ref__in=Item.objects.filter(name__in=managing_items))
+    for managing_item in managing_items:
+        if is_prefix_item(managing_item):
+            authorized |= Q(item_ref__in=Item.objects.filter(name__startswith=get_item_prefix(managing_item)))
 
-    return permission_records
+    return permission_records.filter(authorized)
+
+EXPORT_FIELDS = ('id', 'user_email', 'item', 'permission', 'date_updated')
+
+def iterate_permission_records(permission_records):
+    """
+    Yields the values of the EXPORT_FIELDS of the given records in order of ID. Rows are read a chunk at a
+    time, each chunk starting after the last ID read, so memory use stays flat however many records there are.
+    """
+
+    chunk_size = getattr(settings, 'PERMISSION_BULK_BATCH_SIZE', 500)
+    last_id = 0
+
+    while True:
+        chunk = list(permission_records.filter(id__gt=last_id).order_by('id').values_list(*EXPORT_FIELDS)[:chunk_size])
+
+        for record in chunk:
+            yield dict(zip(EXPORT_FIELDS, record))
+
+        if len(chunk) < chunk_size:
+            return
+
+        last_id = chunk[-1][0]
+
+def format_datetime(value):
+    return timezone.localtime(value).strftime(settings.REST_FRAMEWORK['DATETIME_FORMAT'])
+
+def export_ndjson(records):
+    for record in records:
+        record['date_updated'] = format_datetime(record['date_updated'])
+        yield json.dumps(record) + '\n'
+
+def export_csv(records):
+    # The CSV writer writes to this buffer, and each row is handed on as soon as it is written
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        row = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return row
+
+    writer.writerow(EXPORT_FIELDS)
+    yield flush()
+
+    for record in records:
+        record['date_updated'] = format_datetime(record['date_updated'])
+        writer.writerow([record[field] for field in EXPORT_FIELDS])
+        yield flush()
+
+def get_permission_etag(request, emails=(), items=()):
+    """
+    Returns a strong ETag for a response to the request that depends only on the permissions of the given
+    users and on the given items. It is built from their current permission versions, which every write
+    bumps, so it changes whenever the response could.
+    """
+
+    user_versions = get_user_versions(set(normalize_email(email) for email in emails))
+    item_versions = get_item_versions(set(items))
+
+    parts = [request.get_full_path()]
+    parts += ['user:%s:%s' % version for version in sorted(user_versions.items())]
+    parts += ['item:%s:%s' % version for version in sorted(item_versions.items())]
+
+    return quote_etag(hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest())
+
+def etag_matches(request, etag):
+    """
+    Returns whether the request's If-None-Match header matches the ETag.
+    """
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if not if_none_match:
+        return False
+
+    return if_none_match.strip() == '*' or unquote_etag(etag) in parse_etags(if_none_match)
+
+def get_list_from_data(data, key):
+    """
+    Returns the list of values under the key of the request data, whether it was sent as JSON or as a form.
+    """
+
+    if hasattr(data, 'getlist'):
+        return data.getlist(key)
+
+    value = data.get(key, [])
+    return value if isinstance(value, list) else [value]
+
+def is_nonempty_string(value):
+    return isinstance(value, str) and value != ''
+
+def is_valid_check(check):
+    """
+    Returns whether an entry of a batch check has an item, a permission and, if it names one, an email, all as
+    non-empty strings.
+    """
+
+    if not isinstance(check, dict):
+        return False
+
+    fields = ['item', 'permission'] + (['email'] if 'email' in check else [])
+    return all(is_nonempty_string(check.get(field)) for field in fields)
 
 def get_email_from_jwt(request):
     """
     This function encapsulates the pyauth0jwtrest.utils.get_email_from_request() function
-    to make it easier to mock it in our unit tests.
+    to make it easier to mock it in our unit tests. If the request was authenticated with
+    CachedAuth0JSONWebTokenAuthentication, the email is read from the claims it already decoded.
     """
 
+    if isinstance(request.auth, dict) and 'email' in request.auth:
+        return str(request.auth['email'])
+
     return get_email_from_request(request)
 
 class UserPermissionViewSet(viewsets.ModelViewSet):
@@ -79,6 +212,17 @@ class UserPermissionViewSet(viewsets.ModelViewSet):
     serializer_class = UserPermissionSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
+    @property
+    def paginator(self):
+        """
+        Clients opt in to keyset pagination with ?pagination=cursor, otherwise pages are numbered as before.
+        """
+
+        if not hasattr(self, '_paginator') and self.request.query_params.get('pagination') == 'cursor':
+            self._paginator = UserPermissionCursorPagination()
+
+        return super(UserPermissionViewSet, self).paginator
+
     def get_queryset(self):
 
         # Get the username (email) from the JWT
@@ -91,6 +235,157 @@ class UserPermissionViewSet(viewsets.ModelViewSet):
 
         return get_authorized_user_permissions(request_by_email, requested_user, record_id, item)
 
+    def perform_create(self, serializer):
+        # A concurrent request for the same grant refreshes it rather than failing on the unique constraint
+        data = serializer.validated_data
+        serializer.instance, created = upsert_permission(data['user_email'], data['item'], data['permission'])
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists the UserPermission records the requesting user is authorized to see. Successful responses carry an
+        ETag, and one whose If-None-Match still matches is answered with a 304 without a body.
+        """
+
+        etag = self.get_list_etag(request)
+
+        # ETags are only given to listings that succeeded, and change with the permissions, so a matching one stands
+        # for the same listing and nothing needs to be queried. Only * has to be checked against the listing.
+        if etag is not None and request.META.get('HTTP_IF_NONE_MATCH', '').strip() != '*' and etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        response = super(UserPermissionViewSet, self).list(request, *args, **kwargs)
+
+        # Only a listing that succeeded is cached by clients (RFC 7232, section 5)
+        if etag is None or response.status_code != status.HTTP_200_OK:
+            return response
+
+        if etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        response['ETag'] = etag
+        return response
+
+    def get_list_etag(self, request):
+        """
+        Returns the ETag of the listing, or None for listings by record ID, which do not say whose records they list.
+        """
+
+        if request.query_params.get('id', None):
+            return None
+
+        # The records listed depend on who is asking, the requested user and the requested item
+        emails = [get_email_from_jwt(request), request.query_params.get('email', None)]
+        items = [request.query_params.get('item', None)]
+
+        return get_permission_etag(request, [email for email in emails if email], [item for item in items if item])
+
+    @list_route(methods=['get'])
+    def check(self, request):
+        """
+        Checks whether a user has a permission on an item, answering with an empty 200 if they do and an
+        empty 403 if they do not. Users can check their own permissions and those of others on items they MANAGE.
+        A 200 carries an ETag, and a request whose If-None-Match still matches it is answered with a 304.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        item = request.query_params.get('item', None)
+        object_permission = request.query_params.get('permission', None)
+        requested_user = request.query_params.get('email', request_by_email)
+
+        if not item or not object_permission:
+            return Response('An item and a permission are required.', status=status.HTTP_400_BAD_REQUEST)
+
+        permission_sets = get_check_permission_sets({request_by_email, requested_user})
+
+        # Only managers of the item can check someone else's permissions
+        if normalize_email(requested_user) != normalize_email(request_by_email) and not permission_sets[normalize_email(request_by_email)].manages(item):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        if not permission_sets[normalize_email(requested_user)].has_permission(item, object_permission):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        # Only an allowed check carries an ETag, so a 304 can never stand in for a 403 (RFC 7232, section 5). The
+        # answer only changes with the permissions of the requesting and the requested user.
+        etag = get_permission_etag(request, [request_by_email, requested_user])
+        if etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        return Response(status=status.HTTP_200_OK, headers={'ETag': etag})
+
+    @list_route(methods=['post'])
+    def batch_check(self, request):
+        """
+        Checks a list of {"item", "permission", "email"} entries, where the email defaults to the requesting
+        user, and returns a list of booleans in the same order. As with a single check, users can check their
+        own permissions and those of others on items they MANAGE; any other check is answered with false.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        checks = request.data.get('checks', None)
+        batch_limit = getattr(settings, 'PERMISSION_CHECK_BATCH_LIMIT', 1000)
+
+        if not isinstance(checks, list) or not all(is_valid_check(check) for check in checks):
+            return Response('A list of checks, each with an item, a permission and an optional email as strings, is required.', status=status.HTTP_400_BAD_REQUEST)
+        if len(checks) > batch_limit:
+            return Response('At most %s checks can be made at once.' % batch_limit, status=status.HTTP_400_BAD_REQUEST)
+
+        logger.debug('[DEBUG][SCIAUTHZ][batch_check] - Checking %s permissions for %s.', len(checks), request_by_email)
+
+        # Load the permissions of everyone involved at once
+        emails = set(normalize_email(check.get('email', request_by_email)) for check in checks)
+        permission_sets = get_check_permission_sets(emails | {normalize_email(request_by_email)})
+        requesting_permissions = permission_sets[normalize_email(request_by_email)]
+
+        results = []
+        for check in checks:
+            email = normalize_email(check.get('email', request_by_email))
+
+            if email != normalize_email(request_by_email) and not requesting_permissions.manages(check['item']):
+                results.append(False)
+            else:
+                results.append(permission_sets[email].has_permission(check['item'], check['permission']))
+
+        return Response({'results': results})
+
+    @list_route(methods=['get'])
+    def export(self, request):
+        """
+        Streams every UserPermission record on an item as newline-delimited JSON, or as CSV with ?output=csv.
+        Only users with MANAGE permissions on the item can export it.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        item = request.query_params.get('item', None)
+        output = request.query_params.get('output', 'ndjson')
+
+        if not item or output not in ('ndjson', 'csv'):
+            return Response('An item and an output of ndjson or csv are required.', status=status.HTTP_400_BAD_REQUEST)
+
+        # If the user does not have MANAGE permissions of the item, return 401
+        if not get_permission_set(request_by_email).manages(item):
+            logger.debug('[DEBUG][SCIAUTHZ][export] - Failed to export permissions. %s is not authorized to do this.', request_by_email)
+            return Response('User is not authorized to export these permissions.', status=status.HTTP_401_UNAUTHORIZED)
+
+        logger.debug('[DEBUG][SCIAUTHZ][export] - Exporting permissions on item %s as %s for %s.', item, output, request_by_email)
+
+        records = iterate_permission_records(UserPermission.objects.filter_names(items=[item]))
+
+        if output == 'csv':
+            response = StreamingHttpResponse(export_csv(records), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(export_ndjson(records), content_type='application/x-ndjson')
+
+        # Let nginx pass rows on as they are written
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
     @list_route(methods=['post'])
     def create_item_view_permission_record(self, request):
         """
@@ -105,25 +400,55 @@ class UserPermissionViewSet(viewsets.ModelViewSet):
         item = request.data['item']
         object_permission = "VIEW"
 
-        logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Attempting to create VIEW permission on item %s for user %s, authorized by %s.' % (item, grantee, request_by_email))
+        logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Attempting to create VIEW permission on item %s for user %s, authorized by %s.', item, grantee, request_by_email)
 
         # If the user does not have MANAGE permissions of the item, return 401
-        if UserPermission.objects.filter(item=item, user_email=request_by_email, permission="MANAGE").count() < 1:
-            logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Failed to create VIEW permission. %s is not authorized to do this.' % request_by_email)
+        if not get_permission_set(request_by_email).manages(item):
+            logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Failed to create VIEW permission. %s is not authorized to do this.', request_by_email)
             return Response('User is not authorized to create this permission.', status=status.HTTP_401_UNAUTHORIZED)
 
         # Add the permission if it does not exist
-        new_user_permission, created = UserPermission.objects.get_or_create(
-            item=item,
-            user_email=grantee,
-            permission=object_permission
-        )
+        new_user_permission, created = upsert_permission(grantee, item, object_permission)
 
-        logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Sucessfully created VIEW permission for %s on %s.' % (grantee, item))
+        logger.debug('[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Sucessfully created VIEW permission for %s on %s.', grantee, item)
 
         serializer = self.get_serializer(new_user_permission)
         return Response(serializer.data)
 
+    @list_route(methods=['post'])
+    def bulk_create_item_view_permission_records(self, request):
+        """
+        Creates VIEW UserPermission records for a list of users on one or more items. The requesting
+        user must MANAGE every item. Returns the number of records created and already present.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        # The people getting the VIEW permission
+        grantees = get_list_from_data(request.data, 'grantee_emails')
+        items = get_list_from_data(request.data, 'items') or get_list_from_data(request.data, 'item')
+        object_permission = "VIEW"
+
+        if not grantees or not items or not all(is_nonempty_string(value) for value in grantees + items):
+            return Response('Grantee emails and at least one item are required, as strings.', status=status.HTTP_400_BAD_REQUEST)
+
+        logger.debug('[DEBUG][SCIAUTHZ][bulk_create_item_view_permission_records] - Attempting to create VIEW permission on items %s for %s users, authorized by %s.', items, len(grantees), request_by_email)
+
+        # If the user does not have MANAGE permissions on every item, return 401
+        requesting_permissions = get_permission_set(request_by_email)
+        if not all(requesting_permissions.manages(item) for item in items):
+            logger.debug('[DEBUG][SCIAUTHZ][bulk_create_item_view_permission_records] - Failed to create VIEW permissions. %s is not authorized to do this.', request_by_email)
+            return Response('User is not authorized to create these permissions.', status=status.HTTP_401_UNAUTHORIZED)
+
+        counts = grant_permissions(items, grantees, object_permission)
+
+        return Response({
+            'created': sum(count['created'] for count in counts.values()),
+            'existing': sum(count['existing'] for count in counts.values()),
+            'items': counts
+        })
+
     @list_route(methods=['post'])
     def remove_item_view_permission_record(self, request):
         """
@@ -138,22 +463,84 @@ class UserPermissionViewSet(viewsets.ModelViewSet):
         item = request.data['item']
         object_permission = "VIEW"
 
-        logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Removing VIEW permission on item %s for user %s, authorized by %s.' % (item, grantee, request_by_email))
+        logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Removing VIEW permission on item %s for user %s, authorized by %s.', item, grantee, request_by_email)
 
         # If the user does not have MANAGE permissions of the item, return 401
-        if UserPermission.objects.filter(item=item, user_email=request_by_email, permission="MANAGE").count() < 1:
-            logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Failed to remove VIEW permission. %s is not authorized to do this.' % request_by_email)
+        if not get_permission_set(request_by_email).manages(item):
+            logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Failed to remove VIEW permission. %s is not authorized to do this.', request_by_email)
             return Response('User is not authorized to remove this permission.', status=status.HTTP_401_UNAUTHORIZED)
 
-        # Remove the permission if it exists
-        permission = get_object_or_404(UserPermission, item=item, user_email=grantee, permission=object_permission)
-        permission.delete()
+        # Remove the permission if it exists, along with any record of it under another case of the email
+        permissions = get_list_or_404(UserPermission.objects.filter_names(items=[item], permissions=[object_permission]), normalized_email=normalize_email(grantee))
+        for permission in permissions:
+            permission.delete()
 
-        logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Removed %s' % permission)
+        logger.debug('[DEBUG][SCIAUTHZ][remove_item_view_permission_record] - Removed %s', permission)
 
         serializer = self.get_serializer(permission)
         return Response(serializer.data)
 
+    @list_route(methods=['post'])
+    def bulk_remove_item_view_permission_records(self, request):
+        """
+        Removes the VIEW UserPermission records of a list of users, or with "all" set, of every user, from one
+        or more items. The requesting user must MANAGE every item. Returns the number of records removed.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        # The people losing the VIEW permission
+        grantees = get_list_from_data(request.data, 'grantee_emails')
+        remove_all = str(request.data.get('all', '')).lower() in ('true', '1')
+        items = get_list_from_data(request.data, 'items') or get_list_from_data(request.data, 'item')
+        object_permission = "VIEW"
+
+        if not (grantees or remove_all) or not items or not all(is_nonempty_string(value) for value in grantees + items):
+            return Response('Grantee emails or "all", and at least one item are required, as strings.', status=status.HTTP_400_BAD_REQUEST)
+
+        logger.debug('[DEBUG][SCIAUTHZ][bulk_remove_item_view_permission_records] - Removing VIEW permission on items %s for %s users, authorized by %s.', items, 'all' if remove_all else len(grantees), request_by_email)
+
+        # If the user does not have MANAGE permissions on every item, return 401
+        requesting_permissions = get_permission_set(request_by_email)
+        if not all(requesting_permissions.manages(item) for item in items):
+            logger.debug('[DEBUG][SCIAUTHZ][bulk_remove_item_view_permission_records] - Failed to remove VIEW permissions. %s is not authorized to do this.', request_by_email)
+            return Response('User is not authorized to remove these permissions.', status=status.HTTP_401_UNAUTHORIZED)
+
+        counts = revoke_permissions(items, object_permission, None if remove_all else grantees)
+
+        return Response({
+            'removed': sum(counts.values()),
+            'items': counts
+        })
+
+    @list_route(methods=['post'])
+    def sync_item_view_permission_records(self, request):
+        """
+        Makes the given list of users the only ones with VIEW UserPermission records on an item, creating and
+        removing records as needed. The requesting user must MANAGE the item. Returns the users added and removed.
+        """
+
+        # Get the username (email) from the JWT
+        request_by_email = get_email_from_jwt(self.request)
+
+        # Everyone who should have the VIEW permission
+        grantees = get_list_from_data(request.data, 'grantee_emails')
+        item = request.data.get('item', None)
+        object_permission = "VIEW"
+
+        if 'grantee_emails' not in request.data or not is_nonempty_string(item) or not all(is_nonempty_string(email) for email in grantees):
+            return Response('A list of grantee emails and an item are required, as strings.', status=status.HTTP_400_BAD_REQUEST)
+
+        logger.debug('[DEBUG][SCIAUTHZ][sync_item_view_permission_records] - Syncing VIEW permission on item %s to %s users, authorized by %s.', item, len(grantees), request_by_email)
+
+        # If the user does not have MANAGE permissions of the item, return 401
+        if not get_permission_set(request_by_email).manages(item):
+            logger.debug('[DEBUG][SCIAUTHZ][sync_item_view_permission_records] - Failed to sync VIEW permissions. %s is not authorized to do this.', request_by_email)
+            return Response('User is not authorized to change these permissions.', status=status.HTTP_401_UNAUTHORIZED)
+
+        return Response(sync_permissions(item, grantees, object_permission))
+
     @list_route(methods=['post'])
     def create_registration_permission_record(self, request):
         """
@@ -171,25 +558,16 @@ class UserPermissionViewSet(viewsets.ModelViewSet):
         item_permission_string = "SciReg." + item + ".profile." + request_by_email
         object_permission = "VIEW"
 
-        logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Creating {object} {perm} permission for user {user}.'.format(
-            object=item_permission_string,
-            perm=object_permission,
-            user=grantee
-        ))
+        logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Creating %s %s permission for user %s.', item_permission_string, object_permission, grantee)
 
         grantee_user, created = User.objects.get_or_create(username=grantee, email=grantee)
 
         if created:
-            logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Created Grantee %s' % grantee_user)
+            logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Created Grantee %s', grantee_user)
 
-        new_user_permission, created = UserPermission.objects.get_or_create(
-            item=item_permission_string,
-            user_email=grantee,
-            permission=object_permission,
-            date_updated=datetime.now()
-        )
+        new_user_permission, created = upsert_permission(grantee, item_permission_string, object_permission)
 
-        logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Created %s' % new_user_permission)
+        logger.debug('[DEBUG][SCIAUTHZ][create_registration_permission_record] - Created %s', new_user_permission)
 
         serializer = self.get_serializer(new_user_permission)
         return Response(serializer.data)
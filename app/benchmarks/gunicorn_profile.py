@@ -0,0 +1,205 @@
+"""
+Measures the throughput of SciAuthZ under gunicorn's default profile (one sync worker, a new database
+connection per request) and under SciAuthZ/gunicorn_config.py with persistent connections.
+
+The server runs against a local SQLite database in place of MySQL and a file-based cache in place of
+memcached, with a signing key generated for the run in place of Auth0. Run it from the app directory:
+
+    python benchmarks/gunicorn_profile.py --duration 20 --concurrency 16
+"""
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import jwt
+import requests
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT_ID = "benchmark-client"
+ITEM = "Bench.gunicorn"
+USERS = 50
+
+PROFILES = [
+    ("default", ["gunicorn", "SciAuthZ.wsgi:application"], {"MYSQL_CONN_MAX_AGE": "0"}),
+    ("gunicorn_config", ["gunicorn", "SciAuthZ.wsgi:application", "-c", "SciAuthZ/gunicorn_config.py"], {}),
+]
+
+def make_signing_key(directory):
+    """
+    Creates a key with a self-signed certificate, publishes it in a JWKS file and returns the private key.
+    """
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "sciauthz-benchmark")])
+    certificate = x509.CertificateBuilder()\
+        .subject_name(name)\
+        .issuer_name(name)\
+        .public_key(private_key.public_key())\
+        .serial_number(1)\
+        .not_valid_before(datetime(2000, 1, 1))\
+        .not_valid_after(datetime(2100, 1, 1))\
+        .sign(private_key, hashes.SHA256(), default_backend())
+
+    jwks = {"keys": [{"kid": "benchmark-key", "x5c": [base64.b64encode(certificate.public_bytes(serialization.Encoding.DER)).decode("ascii")]}]}
+
+    jwks_file = os.path.join(directory, "jwks.json")
+    with open(jwks_file, "w") as f:
+        json.dump(jwks, f)
+
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+
+    return jwks_file, private_pem
+
+def make_token(private_pem, email):
+    return jwt.encode(
+        {"email": email, "aud": CLIENT_ID, "exp": int(time.time()) + 3600},
+        private_pem,
+        algorithm="RS256",
+        headers={"kid": "benchmark-key"}
+    ).decode("ascii")
+
+def prepare_database(env):
+    """
+    Migrates the stand-in database and grants each benchmark user VIEW on the item.
+    """
+
+    subprocess.check_call([sys.executable, "manage.py", "migrate", "--verbosity", "0"], cwd=APP_DIR, env=env)
+
+    script = (
+        "from authorization.models import UserPermission\n"
+        "for i in range(%s):\n"
+        "    UserPermission.objects.create(user_email='bench%%s@example.org' %% i, item='%s', permission='VIEW')\n"
+        % (USERS, ITEM)
+    )
+    subprocess.check_call([sys.executable, "manage.py", "shell", "-c", script], cwd=APP_DIR, env=env)
+
+def wait_for_server(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url + "/ht/", timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start within %s seconds." % timeout)
+
+def run_load(url, tokens, duration, concurrency):
+    """
+    Sends permission checks from concurrent clients for the duration and returns the request latencies.
+    """
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(index):
+        session = requests.Session()
+        headers = {"Authorization": "JWT " + tokens[index % len(tokens)]}
+        params = {"item": ITEM, "permission": "VIEW"}
+        own_latencies = []
+        own_errors = 0
+
+        while time.time() < stop_at:
+            started = time.time()
+            try:
+                response = session.get(url + "/user_permission/check/", params=params, headers=headers, timeout=10)
+                if response.status_code != 200:
+                    own_errors += 1
+            except requests.exceptions.RequestException:
+                own_errors += 1
+            own_latencies.append(time.time() - started)
+
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sorted(latencies), sum(errors)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=int, default=20, help="Seconds of load per profile.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="sciauthz-benchmark-")
+    url = "http://127.0.0.1:%s" % args.port
+
+    try:
+        jwks_file, private_pem = make_signing_key(directory)
+
+        env = dict(os.environ)
+        env.update({
+            "DATABASE_ENGINE": "django.db.backends.sqlite3",
+            "DATABASE_NAME": os.path.join(directory, "sciauthz.sqlite3"),
+            "CACHE_BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "CACHE_LOCATION": os.path.join(directory, "cache"),
+            "AUTH0_CLIENT_ID_LIST": CLIENT_ID,
+            "AUTH0_JWKS_FILE": jwks_file,
+            "SECRET_KEY": env.get("SECRET_KEY", "benchmark"),
+            "ALLOWED_HOSTS": "127.0.0.1",
+        })
+
+        prepare_database(env)
+        tokens = [make_token(private_pem, "bench%s@example.org" % i) for i in range(USERS)]
+
+        print("%-16s %10s %10s %10s %10s %8s" % ("profile", "requests/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+
+        for name, command, profile_env in PROFILES:
+            server_env = dict(env, **profile_env)
+            server = subprocess.Popen(command + ["--bind", "127.0.0.1:%s" % args.port], cwd=APP_DIR,
+                                      env=server_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_server(url)
+                latencies, errors = run_load(url, tokens, args.duration, args.concurrency)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+
+            print("%-16s %10.1f %10.1f %10.1f %10.1f %8s" % (
+                name,
+                len(latencies) / float(args.duration),
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                errors
+            ))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures the time a request spends logging the debug messages of a view like those in authorization/views.py,
+under the old logging setup and the new one. The handlers write to stdout and a log file as settings.LOGGING
+does, with stdout sent to /dev/null. Between requests the benchmark waits as a request would on the database,
+which is when the background thread writes out the queued records. Run it from the app directory:
+
+    python benchmarks/logging_overhead.py --requests 5000
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SciAuthZ.log_handlers import BackgroundHandler
+
+MESSAGE = '[DEBUG][SCIAUTHZ][create_item_view_permission_record] - Attempting to create VIEW permission on item %s for user %s, authorized by %s.'
+ARGS = ('Sci.Test', 'user@example.com', 'manager@example.com')
+
+def make_handlers(directory, name):
+    console = logging.StreamHandler(open(os.devnull, 'w'))
+    file_debug = logging.FileHandler(os.path.join(directory, name + '.log'))
+
+    return [console, file_debug]
+
+def make_logger(name, level, handlers):
+    logger = logging.getLogger('benchmark.' + name)
+    logger.propagate = False
+    logger.setLevel(level)
+    for handler in handlers:
+        logger.addHandler(handler)
+    return logger
+
+def time_eager(logger, requests, messages, wait):
+    elapsed = 0.0
+    for i in range(requests):
+        started = time.perf_counter()
+        for j in range(messages):
+            logger.debug(MESSAGE % ARGS)
+        elapsed += time.perf_counter() - started
+        time.sleep(wait)
+    return elapsed
+
+def time_lazy(logger, requests, messages, wait):
+    elapsed = 0.0
+    for i in range(requests):
+        started = time.perf_counter()
+        for j in range(messages):
+            logger.debug(MESSAGE, *ARGS)
+        elapsed += time.perf_counter() - started
+        time.sleep(wait)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="Number of requests per case.")
+    parser.add_argument("--messages", type=int, default=3, help="Number of debug messages logged per request.")
+    parser.add_argument("--wait", type=float, default=0.001, help="Seconds each request waits on the database.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="sciauthz-logging-")
+
+    # The old setup: synchronous handlers, messages formatted before the call
+    sync_logger = make_logger('sync', logging.DEBUG, make_handlers(directory, 'sync'))
+    sync_info_logger = make_logger('sync_info', logging.INFO, make_handlers(directory, 'sync_info'))
+
+    # The new setup: handlers behind a queue, messages formatted by the listener
+    queue_handlers = make_handlers(directory, 'queue')
+    background = BackgroundHandler(queue_handlers)
+    queue_logger = make_logger('queue', logging.DEBUG, [background])
+    queue_info_logger = make_logger('queue_info', logging.INFO, [background])
+
+    cases = [
+        ("DEBUG, synchronous, eager %", time_eager, sync_logger),
+        ("DEBUG, queued, lazy args", time_lazy, queue_logger),
+        ("INFO, synchronous, eager %", time_eager, sync_info_logger),
+        ("INFO, queued, lazy args", time_lazy, queue_info_logger),
+    ]
+
+    print("%-30s %14s" % ("case", "us per request"))
+    for name, timer, logger in cases:
+        elapsed = timer(logger, args.requests, args.messages, args.wait)
+        print("%-30s %14.2f" % (name, elapsed / args.requests * 1000000))
+
+    # Wait for the listener to write out what is left on the queue
+    background.close()
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,9 @@ EMAIL_PORT=$(aws ssm get-parameters --names $PS_PATH.email_port --with-decryptio
 ALLOWED_HOSTS=$(aws ssm get-parameters --names $PS_PATH.allowed_hosts --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
 RAVEN_URL=$(aws ssm get-parameters --names $PS_PATH.raven_url --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
 
+CACHE_LOCATION=$(aws ssm get-parameters --names $PS_PATH.cache_location --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
+METRICS_TOKEN=$(aws ssm get-parameters --names $PS_PATH.metrics_token --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
+
 
 export SECRET_KEY=$DJANGO_SECRET
 export AUTH0_DOMAIN=$AUTH0_DOMAIN_VAULT
@@ -40,6 +43,12 @@ export EMAIL_PORT
 
 export ALLOWED_HOSTS
 export RAVEN_URL
+export METRICS_TOKEN
+
+# The workers share permission versions through memcached
+export CACHE_BACKEND=${CACHE_BACKEND:-django.core.cache.backends.memcached.MemcachedCache}
+export CACHE_LOCATION
+export LOG_LEVEL=${LOG_LEVEL:-INFO}
 
 SSL_KEY=$(aws ssm get-parameters --names $PS_PATH.ssl_key --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
 SSL_CERT_CHAIN1=$(aws ssm get-parameters --names $PS_PATH.ssl_cert_chain1 --with-decryption --region us-east-1 | jq -r '.Parameters[].Value')
@@ -57,9 +66,30 @@ if [ ! -d static ]; then
     mkdir static
 fi
 
+# Refuse to start with settings that fail Django's checks, such as a cache the workers do not share
+python manage.py check || exit 1
+
 python manage.py migrate
 python manage.py collectstatic --no-input
 
 /etc/init.d/nginx restart
 
-gunicorn SciAuthZ.wsgi:application -b 0.0.0.0:8004
\ No newline at end of file
+# Keep the permission snapshot that the workers answer checks from up to date. The refresher is restarted
+# whenever it exits, and stopped when this script exits.
+if [ -n "$PERMISSION_SNAPSHOT_PATH" ]; then
+    python manage.py refresh_permission_snapshot
+
+    (
+        trap 'kill $REFRESHER 2>/dev/null; exit' TERM
+        while true; do
+            python manage.py refresh_permission_snapshot --watch &
+            REFRESHER=$!
+            wait $REFRESHER
+            echo "refresh_permission_snapshot exited with status $?, restarting it in 10 seconds" >&2
+            sleep 10
+        done
+    ) &
+    trap "kill $! 2>/dev/null" EXIT
+fi
+
+gunicorn SciAuthZ.wsgi:application -c SciAuthZ/gunicorn_config.py
\ No newline at end of file